@@ -1,5 +1,6 @@
 import numpy as np
 import itertools
+from collections.abc import Sequence
 from searchspace_options import (
 	get_config_options,
 	get_illegal_sets,
@@ -38,6 +39,7 @@ class Config(object):
 		self.stage_map = list(self.config.keys())
 		self.total_configs = np.prod([len(v) for k, v in self.config.items()])
 		self.illegal_sets = get_illegal_sets(self.base_config)
+		self.illegal_tables = self.build_illegal_tables()
 
 	def isBERTTransform(self):
 		return 'BERT' in list(self.config['T'].values())
@@ -59,14 +61,43 @@ class Config(object):
 	def get_name(self, stage_idx, atom_idx):
 		return self.config[self.stage_map[stage_idx]][atom_idx]
 
+	def stage_sizes(self):
+		return [len(self.get_stage(stage_id)) for stage_id in range(self.num_stages())]
+
+	def build_illegal_tables(self):
+		# For every pair of stages (i < j), a boolean table with entry [a, b] set if the
+		# pair (op_a of stage i, op_b of stage j) is illegal. Pairs with no illegal entries are dropped.
+		illegal_sets = set(self.illegal_sets)
+		tables = {}
+		for i, j in itertools.combinations(range(self.num_stages()), 2):
+			names_i, names_j = self.get_stage(i), self.get_stage(j)
+			table = np.zeros((len(names_i), len(names_j)), dtype=bool)
+			for a, name_a in names_i.items():
+				for b, name_b in names_j.items():
+					table[a, b] = (name_a, name_b) in illegal_sets
+			if table.any():
+				tables[(i, j)] = table
+		return tables
+
+	def get_illegal_mask(self):
+		# Broadcast the pairwise tables over the full stage product. Works for any number of stages
+		dims = self.stage_sizes()
+		illegal = np.zeros(dims, dtype=bool)
+		for (i, j), table in self.illegal_tables.items():
+			shape = [1 for _ in dims]
+			shape[i], shape[j] = dims[i], dims[j]
+			illegal |= table.reshape(shape)
+		return illegal
+
+	def get_valid_space(self):
+		if not hasattr(self, 'valid_space'):
+			self.valid_space = ValidConfigSpace(self)
+		return self.valid_space
+
 	def is_illegal(self, tuple_):
-		assert len(tuple_) == 4, 'This assumes that there are only 4 stages. If not, please consider re-writing this function'
-		op_list = []
-		for stage_id, idx in enumerate(tuple_):
-			op_name = self.get_stage(stage_id)[idx]
-			op_list.append(op_name)
-		for combo in itertools.combinations(op_list, 2):
-			if combo in self.illegal_sets:
+		assert len(tuple_) == self.num_stages(), 'Config must have one entry per stage'
+		for (i, j), table in self.illegal_tables.items():
+			if table[tuple_[i], tuple_[j]]:
 				return True
 		return False
 	
@@ -108,6 +139,148 @@ class Config(object):
 		out_name = self.config['O'][output_id]
 		return out_name in ALL_SUPERVISED_OUTPUTS.keys()
 
+class ValidConfigSpace(Sequence):
+	'''
+		Lazy, lexicographically ordered view of the valid configurations of a Config. Valid configs are counted
+		with a DP over the stages whose state holds, for every stage not yet fixed, the bitmask of its options
+		that are still legal given the choices made so far. Counts are memoized per state so counting, ranking,
+		unranking and sampling never enumerate the full product of the stages.
+	'''
+	def __init__(self, config):
+		self.config = config
+		self.sizes = config.stage_sizes()
+		full_masks = [(1 << size) - 1 for size in self.sizes]
+		# allowed[i][a][j] : options of stage j that are legal alongside option a of stage i (only used for j > i)
+		self.allowed = [[list(full_masks) for _ in range(size)] for size in self.sizes]
+		for (i, j), table in config.illegal_tables.items():
+			for a in range(self.sizes[i]):
+				self.allowed[i][a][j] = sum([1 << b for b in range(self.sizes[j]) if not table[a, b]])
+		self.start = tuple(full_masks)
+		self.counts = {}
+		self.length = self.count(0, self.start)
+
+	def options(self, mask):
+		return [a for a in range(mask.bit_length()) if (mask >> a) & 1]
+
+	def restrict(self, stage_id, option, masks):
+		# masks cover stages stage_id, ..., num_stages - 1. Returns the masks of the later stages once option is chosen
+		allowed = self.allowed[stage_id][option]
+		return tuple([mask & allowed[stage_id + 1 + k] for k, mask in enumerate(masks[1:])])
+
+	def count(self, stage_id, masks):
+		# Number of valid completions given the masks of stages stage_id onwards
+		if stage_id == len(self.sizes):
+			return 1
+		if stage_id == len(self.sizes) - 1:
+			return bin(masks[0]).count('1')
+		key_ = (stage_id, masks)
+		if key_ not in self.counts:
+			self.counts[key_] = sum([
+										self.count(stage_id + 1, self.restrict(stage_id, a, masks))
+										for a in self.options(masks[0])
+								])
+		return self.counts[key_]
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, rank):
+		# Unrank : walk down the stages, skipping over the blocks of configs that come before rank
+		if rank < 0:
+			rank += self.length
+		if not (0 <= rank < self.length):
+			raise IndexError('Config rank out of range')
+		config_, masks = [], self.start
+		for stage_id in range(len(self.sizes)):
+			for a in self.options(masks[0]):
+				next_masks = self.restrict(stage_id, a, masks)
+				block = self.count(stage_id + 1, next_masks)
+				if rank < block:
+					break
+				rank -= block
+			config_.append(a)
+			masks = next_masks
+		return tuple(config_)
+
+	def index(self, config_):
+		# Rank : the number of valid configs that come before config_ in lexicographic order
+		if (len(config_) != len(self.sizes)) or self.config.is_illegal(config_):
+			raise ValueError('{} is not a valid config'.format(config_))
+		rank, masks = 0, self.start
+		for stage_id, option in enumerate(config_):
+			if not ((masks[0] >> option) & 1):
+				raise ValueError('{} is not a valid config'.format(config_))
+			for a in self.options(masks[0]):
+				if a == option:
+					break
+				rank += self.count(stage_id + 1, self.restrict(stage_id, a, masks))
+			masks = self.restrict(stage_id, option, masks)
+		return rank
+
+	def __contains__(self, config_):
+		try:
+			self.index(tuple(config_))
+			return True
+		except (ValueError, IndexError, TypeError):
+			return False
+
+	def __iter__(self):
+		def extend(stage_id, prefix, masks):
+			for a in self.options(masks[0]):
+				if stage_id == len(self.sizes) - 1:
+					yield prefix + (a,)
+				else:
+					yield from extend(stage_id + 1, prefix + (a,), self.restrict(stage_id, a, masks))
+		return extend(0, (), self.start)
+
+	def sample(self, num_samples, stage_probas=None, max_tries=100):
+		'''
+			Samples num_samples distinct valid configs. Without stage_probas, configs are uniform over the valid space.
+			With stage_probas (one array of option probabilities per stage), a config is drawn with probability
+			proportional to the product of its option probabilities. Duplicates are redrawn, up to
+			max_tries * num_samples draws, so fewer configs can come back when the weights are very peaked.
+		'''
+		if num_samples >= self.length:
+			return list(self)
+		if stage_probas is None:
+			draw = lambda: self[np.random.randint(self.length)]
+		else:
+			partition = {}
+			draw = lambda: self.sample_weighted(stage_probas, partition)
+		samples = {}
+		for _ in range(max_tries * num_samples):
+			samples[draw()] = True
+			if len(samples) == num_samples:
+				break
+		return list(samples.keys())
+
+	def sample_weighted(self, stage_probas, partition):
+		# partition memoizes the weighted counts (the normalizer of each state) for this set of stage_probas
+		def weight(stage_id, masks):
+			if stage_id == len(self.sizes):
+				return 1.0
+			key_ = (stage_id, masks)
+			if key_ not in partition:
+				partition[key_] = sum([
+										stage_probas[stage_id][a] * weight(stage_id + 1, self.restrict(stage_id, a, masks))
+										for a in self.options(masks[0])
+									])
+			return partition[key_]
+
+		config_, masks = [], self.start
+		for stage_id in range(len(self.sizes)):
+			options = self.options(masks[0])
+			next_masks = [self.restrict(stage_id, a, masks) for a in options]
+			option_weights = np.array([
+										stage_probas[stage_id][a] * weight(stage_id + 1, next_)
+										for a, next_ in zip(options, next_masks)
+									])
+			choice = np.random.choice(len(options), p=option_weights / option_weights.sum())
+			config_.append(options[choice])
+			masks = next_masks[choice]
+		return tuple(config_)
+
+
 def run_tests():
 	try:
 		full_config = Config('full')
@@ -125,5 +298,37 @@ def run_tests():
 		msg = 'Failed.'
 	print("run_tests : {}".format(msg))
 
+def test_illegal_mask():
+	try:
+		full_config = Config('full')
+		illegal = full_config.get_illegal_mask()
+		assert list(illegal.shape) == full_config.stage_sizes(), 'Mask should span the full stage product'
+		for tuple_ in itertools.product(*[range(x) for x in illegal.shape]):
+			assert illegal[tuple_] == full_config.is_illegal(tuple_), 'Mask disagrees with is_illegal at {}'.format(tuple_)
+		msg = 'Passed.'
+	except:
+		msg = 'Failed.'
+	print("test_illegal_mask : {}".format(msg))
+
+def test_valid_space():
+	try:
+		full_config = Config('full')
+		space = full_config.get_valid_space()
+		stages = [range(x) for x in full_config.stage_sizes()]
+		valid = [tuple_ for tuple_ in itertools.product(*stages) if not full_config.is_illegal(tuple_)]
+		assert len(space) == len(valid), 'Expected {} valid configs but counted {}'.format(len(valid), len(space))
+		assert list(space) == valid, 'Iteration should follow lexicographic order'
+		for rank, tuple_ in enumerate(valid):
+			assert space[rank] == tuple_, 'Unrank mismatch at {}'.format(rank)
+			assert space.index(tuple_) == rank, 'Rank mismatch for {}'.format(tuple_)
+		samples = space.sample(10)
+		assert len(set(samples)) == 10 and all([x in space for x in samples]), 'Samples should be distinct valid configs'
+		msg = 'Passed.'
+	except:
+		msg = 'Failed.'
+	print("test_valid_space : {}".format(msg))
+
 if __name__ == '__main__':
-	run_tests()
\ No newline at end of file
+	run_tests()
+	test_illegal_mask()
+	test_valid_space()
\ No newline at end of file
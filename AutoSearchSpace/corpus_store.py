@@ -0,0 +1,258 @@
+import os
+import json
+import hashlib
+import shutil
+import multiprocessing
+from array import array
+from collections import deque
+from collections.abc import Sequence
+import numpy as np
+
+# Bump this whenever the layout of the stored arrays changes so stale caches are not picked up
+STORE_VERSION = 2
+TOKENIZE_CHUNK = 10000
+COUNT_CHUNK = 1 << 24
+# File under the cache dir holding the content hash of every corpus file seen so far
+CONTENT_HASHES = 'content_hashes.json'
+
+
+def hash_file(path):
+	hasher = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			hasher.update(block)
+	return hasher.hexdigest()
+
+
+def hash_files(file_paths, cache_dir=None):
+	# Content hashes are cached under cache_dir keyed on (path, size, mtime) so an unchanged corpus is not reread
+	hashes_path = os.path.join(cache_dir, CONTENT_HASHES) if cache_dir is not None else None
+	known = {}
+	if hashes_path is not None and os.path.exists(hashes_path):
+		with open(hashes_path, 'r') as f:
+			known = json.load(f)
+	hasher, updated = hashlib.sha1(), False
+	for path in file_paths:
+		stat_ = os.stat(path)
+		stat_key = "{}|{}|{}".format(os.path.abspath(path), stat_.st_size, stat_.st_mtime_ns)
+		if stat_key not in known:
+			known[stat_key] = hash_file(path)
+			updated = True
+		hasher.update(known[stat_key].encode('utf-8'))
+	if updated and hashes_path is not None:
+		os.makedirs(cache_dir, exist_ok=True)
+		# Write then rename so concurrent runs never see a partial file
+		tmp_path = "{}.{}".format(hashes_path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			json.dump(known, f)
+		os.replace(tmp_path, hashes_path)
+	return hasher.hexdigest()
+
+
+def get_store_key(file_paths, tokenizer, cache_dir=None):
+	# A store depends on the exact bytes of the corpus and on the tokenizer that produced the ids
+	tokenizer_desc = "{}|{}|{}|{}".format(
+							type(tokenizer).__name__, getattr(tokenizer, 'name_or_path', ''),
+							len(tokenizer), STORE_VERSION
+					)
+	key_ = hashlib.sha1("{}|{}".format(hash_files(file_paths, cache_dir), tokenizer_desc).encode('utf-8'))
+	return key_.hexdigest()
+
+
+# Tokenizer of a tokenization pool worker. Set once per worker by init_tokenize_worker
+WORKER_TOKENIZER = None
+
+
+def init_tokenize_worker(tokenizer):
+	global WORKER_TOKENIZER
+	# The rust tokenizers' own thread pool does not survive being forked
+	os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+	WORKER_TOKENIZER = tokenizer
+
+
+def encode_chunk(lines, tokenizer=None):
+	# Token ids without special tokens. These are added (and sequences truncated) when batches are collated
+	tokenizer = WORKER_TOKENIZER if tokenizer is None else tokenizer
+	return tokenizer.batch_encode_plus(lines, add_special_tokens=False)['input_ids']
+
+
+def count_ids(ids, vocab_size):
+	# Token counts over a (memory-mapped) id array, a slice at a time so only COUNT_CHUNK ids are ever copied
+	counts = np.zeros(vocab_size, dtype=np.int64)
+	for start in range(0, len(ids), COUNT_CHUNK):
+		counts += np.bincount(ids[start: start + COUNT_CHUNK], minlength=vocab_size)[:vocab_size]
+	return counts
+
+
+def encode_chunks(chunks, tokenizer, pool=None, max_pending=1):
+	'''
+		Yields the ids of every chunk in chunk order. With a pool, up to max_pending chunks are kept in flight so
+		workers pick up new chunks as soon as they finish one, without reading the whole corpus ahead of them.
+	'''
+	if pool is None:
+		for chunk in chunks:
+			yield encode_chunk(chunk, tokenizer)
+		return
+	pending = deque()
+	for chunk in chunks:
+		pending.append(pool.apply_async(encode_chunk, (chunk, )))
+		if len(pending) >= max_pending:
+			yield pending.popleft().get()
+	while len(pending) > 0:
+		yield pending.popleft().get()
+
+
+def scan_lines(file_path):
+	# Yields (byte offset, line) for every line we keep. Reading in binary gives offsets we can seek back to
+	with open(file_path, 'rb') as f:
+		offset = 0
+		for raw_line in f:
+			line = raw_line.decode('utf-8').strip()
+			if len(line) >= 2: # Remove all single letter or empty lines
+				yield offset, line
+			offset += len(raw_line)
+
+
+def iter_windows(items, window_size):
+	window = []
+	for item in items:
+		window.append(item)
+		if len(window) == window_size:
+			yield window
+			window = []
+	if len(window) > 0:
+		yield window
+
+
+def write_npy_from_raw(raw_path, npy_path, dtype, count):
+	# Wraps a file of raw values written incrementally into a .npy file without loading it in memory
+	header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (count, )}
+	with open(npy_path, 'wb') as out_f, open(raw_path, 'rb') as in_f:
+		np.lib.format.write_array_header_1_0(out_f, header)
+		shutil.copyfileobj(in_f, out_f)
+	os.remove(raw_path)
+
+
+class LineReader(Sequence):
+	'''
+		Random access to the lines of a corpus without holding them in memory. Every line is read back by
+		seeking to its byte offset in the file of its document.
+	'''
+	def __init__(self, file_paths, line_starts, doc_lens):
+		self.file_paths = file_paths
+		self.line_starts = line_starts
+		self.doc_lens = doc_lens
+		self.handles = {}
+
+	def __len__(self):
+		return len(self.line_starts)
+
+	def get_handle(self, doc_idx):
+		if doc_idx not in self.handles:
+			self.handles[doc_idx] = open(self.file_paths[doc_idx], 'rb')
+		return self.handles[doc_idx]
+
+	def __getitem__(self, line_idx):
+		if line_idx < 0 or line_idx >= len(self):
+			raise IndexError(line_idx)
+		doc_idx = np.searchsorted(self.doc_lens, line_idx, side='right') - 1
+		f = self.get_handle(doc_idx)
+		f.seek(int(self.line_starts[line_idx]))
+		return f.readline().decode('utf-8').strip()
+
+	def close(self):
+		for f in self.handles.values():
+			f.close()
+		self.handles = {}
+
+
+class CorpusStore(object):
+	'''
+		Pre-tokenized corpus. The token ids of every line are held in one flat int32 array, with offsets[i] and
+		offsets[i + 1] delimiting line i, and doc_lens holding the cumulative number of lines per document.
+		Stores are built once, written to a cache directory keyed by the corpus and tokenizer, and then opened
+		as memory maps so that concurrent runs on a host share the same pages.
+	'''
+	ARRAYS = ['ids', 'offsets', 'doc_lens', 'line_starts']
+
+	def __init__(self, ids, offsets, doc_lens, line_starts):
+		self.ids = ids
+		self.offsets = offsets
+		self.doc_lens = doc_lens
+		self.line_starts = line_starts  # byte offset of each line in the file of its document
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def get_ids(self, line_idx):
+		return self.ids[self.offsets[line_idx]: self.offsets[line_idx + 1]]
+
+	def get_doc_ids(self, doc_idx):
+		# The ids of all the lines of a document, as one contiguous slice
+		return self.ids[self.offsets[self.doc_lens[doc_idx]]: self.offsets[self.doc_lens[doc_idx + 1]]]
+
+	def get_lines(self, file_paths):
+		return LineReader(file_paths, self.line_starts, self.doc_lens)
+
+	@staticmethod
+	def build(file_paths, tokenizer, path, num_workers=1):
+		'''
+			Streams the documents through the tokenizer so that building a store needs memory for the line
+			index but not for the corpus. Lines are encoded in chunks of TOKENIZE_CHUNK. With several workers the
+			chunks are spread over a process pool and the results come back in chunk order, so the ids do not
+			depend on the number of workers. The store is written to a temporary directory first and
+			renamed into place, so readers never see a partial store.
+		'''
+		tmp_path = "{}.tmp-{}".format(path, os.getpid())
+		os.makedirs(tmp_path, exist_ok=True)
+		raw_ids_path = os.path.join(tmp_path, 'ids.bin')
+		line_starts, lens, doc_lens = array('q'), array('q'), [0]
+
+		def doc_chunks():
+			for file_path in file_paths:
+				num_lines = 0
+				for lines in iter_windows(scan_lines(file_path), TOKENIZE_CHUNK):
+					line_starts.extend([offset for offset, _ in lines])
+					num_lines += len(lines)
+					yield [line for _, line in lines]
+				doc_lens.append(num_lines)
+
+		pool = None
+		if num_workers > 1:
+			pool = multiprocessing.Pool(num_workers, initializer=init_tokenize_worker, initargs=(tokenizer,))
+		try:
+			with open(raw_ids_path, 'wb') as ids_f:
+				for chunk_ids in encode_chunks(doc_chunks(), tokenizer, pool=pool, max_pending=2 * num_workers):
+					for line_ids in chunk_ids:
+						lens.append(len(line_ids))
+						ids_f.write(np.array(line_ids, dtype=np.int32).tobytes())
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+
+		offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+		offsets[1:] = np.cumsum(np.frombuffer(lens, dtype=np.int64))
+		write_npy_from_raw(raw_ids_path, os.path.join(tmp_path, 'ids.npy'), np.int32, int(offsets[-1]))
+		np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+		np.save(os.path.join(tmp_path, 'doc_lens.npy'), np.cumsum(doc_lens))
+		np.save(os.path.join(tmp_path, 'line_starts.npy'), np.frombuffer(line_starts, dtype=np.int64))
+		try:
+			os.replace(tmp_path, path)
+		except OSError:
+			# Another process finished building the same store first
+			shutil.rmtree(tmp_path, ignore_errors=True)
+
+	@classmethod
+	def load(cls, path):
+		arrays = [np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode='r') for name in cls.ARRAYS]
+		return cls(*arrays)
+
+	@classmethod
+	def load_or_build(cls, file_paths, tokenizer, cache_dir, num_workers=1):
+		path = os.path.join(cache_dir, get_store_key(file_paths, tokenizer, cache_dir))
+		if not os.path.isdir(path):
+			print('Building corpus store at : ', path)
+			os.makedirs(cache_dir, exist_ok=True)
+			cls.build(file_paths, tokenizer, path, num_workers=num_workers)
+		return cls.load(path)
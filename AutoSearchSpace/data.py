@@ -4,8 +4,10 @@ import logging
 import json
 import unicodedata
 import numpy as np
-from collections import Counter, defaultdict
+from collections import OrderedDict
 from data_utils import *
+from corpus_store import CorpusStore, scan_lines, count_ids
+from searchspace_options import ALL_TOKEN_CLASSF
 import math
 import pdb
 
@@ -26,6 +28,10 @@ def add_data_args(parser):
 	parser.add_argument('-in-domain-data', type=str, default=None)
 	parser.add_argument('-out-domain-data', type=str, default=None)
 	parser.add_argument('-neural-lm-data', type=str, default=None)
+	parser.add_argument('-corpus-cache-dir', type=str, default='corpus_cache', help='Where pre-tokenized corpora are cached')
+	parser.add_argument('-stream-corpus', action='store_true', help='Read lines from disk when sampled instead of keeping the corpus in memory')
+	parser.add_argument('-tokenize-workers', type=int, default=4, help='Processes used to tokenize a corpus the first time it is seen')
+	parser.add_argument('-cap-cache-size', type=int, default=100000, help='Max number of sentences with cached CAP labels')
 
 
 DATA_PATHS = {
@@ -107,96 +113,127 @@ class MNLIDataset(Dataset):
 
 
 class LineByLineRawTextDataset(Dataset):
-	def __init__(self, file_path, tokenizer, tf_or_idf_present, cap_present, max_=10):
+	def __init__(self, file_path, tokenizer, tf_or_idf_present, cap_present, max_=10, cap_cache_size=100000, cache_dir='corpus_cache', num_workers=1, stream=False):
 		assert os.path.isfile(file_path)
 		logger.info("Creating Raw Line x Line Dataset %s", file_path)
 		
-		all_lines = []
-		all_tokens = []
-		self.doc_lens = []
-		self.doc_names = []
 		self.max_ = max_
 		self.is_supervised = False
+		# CAP labels are computed lazily, the first time a sentence is used, and kept in a bounded LRU cache
+		self.tokenizer = tokenizer
+		self.cap_present = cap_present
+		self.cap_cache = OrderedDict()
+		self.cap_cache_size = cap_cache_size
 
-		if cap_present:
-			all_caps = []
-		if tf_or_idf_present:
-			doc_tfs = Counter()
-			self.doc_tfs = {}
-	
 		if '.json' in file_path:
 			docs = json.load(open(file_path, 'r'))
 		else:
 			docs = {'0': file_path}
-		# Process each document
-		self.doc_lens.append(0)
-		for doc_id, file_path in docs.items():
-			self.doc_names.append(doc_id)
-			# Get the lines, token frequencies and capitalization
-			freq_cntr, lines, tokens, caps = self.process_single_file(file_path, tokenizer, tf_or_idf_present, cap_present)
-			all_tokens.extend(tokens)
-			all_lines.extend(lines)
-			self.doc_lens.append(len(lines))
-			if cap_present:
-				all_caps.extend(caps)
-			if tf_or_idf_present:
-				tf_info = scale(freq_cntr, max_=self.max_, smoothfactor=1)
-				keys, values = list(tf_info.keys()), np.ceil(np.log10(list(tf_info.values())))
-				# get the minimum value
-				to_add = min(values) * np.sign(min(values)) + 1
-				values = values + to_add
-				tf_info = defaultdict(int)
-				for k, v in zip(keys, values):
-					tf_info[k] = v if v < 3 else 3  # This is currently hard-coded to ensure that we have 7 classes. Need to fix
-				self.doc_tfs[doc_id] = tf_info
-				doc_tfs.update(list(freq_cntr.keys()))
-
-		self.examples = all_lines
-		self.tokens = all_tokens
-		self.doc_lens = np.cumsum(self.doc_lens)
+		# Token ids come from the corpus store, which is only built (tokenizing everything) the first time this
+		# corpus is seen with this tokenizer. When streaming, lines are read back from disk by their byte offsets
+		doc_paths = list(docs.values())
+		self.store = CorpusStore.load_or_build(doc_paths, tokenizer, cache_dir, num_workers=num_workers)
+		self.doc_names = list(docs.keys())
+		self.doc_lens = np.array(self.store.doc_lens)
+		if stream:
+			self.examples = self.store.get_lines(doc_paths)
+		else:
+			self.examples = [line for path in doc_paths for line in self.process_single_file(path)]
+			assert len(self.examples) == len(self.store), 'Corpus store does not match the corpus'
 		if tf_or_idf_present:
-			# need to do some idf computation here
-			smoothed_n = 1 + len(docs)
-			doc_idfs = {x : np.log(smoothed_n/(1 + v) + 1.0) for x, v in doc_tfs.items()}
-			self.doc_tfidfs = self.get_tfidfs(self.doc_tfs, doc_idfs)
-		if cap_present:
-			self.caps = all_caps
-			assert len(self.caps) == len(self.examples), 'The number of caps should match the number of example sentences'
-
-
-	def get_tfidfs(self, doc_tfs, doc_idfs):
-		doc_tfidfs = defaultdict(lambda:defaultdict(float))
-		for k, tf in doc_tfs.items():
-			new_tfidf = {x: v * doc_idfs[x] for x, v in tf.items()}
-			doc_tfidfs[k] = scale(new_tfidf, smoothfactor=1)
-		return doc_tfidfs
-
-	def process_single_file(self, file_path, tokenizer, tf_or_idf_present, cap_present):
-		with open(file_path, encoding="utf-8") as f:
-			token_counter = Counter() if tf_or_idf_present else None
-			lines = []
-			all_tokens = []
-			capitalizations = [] if cap_present else None
-			for line in f.readlines():
-				line = line.strip()
-				if len(line) < 2: # Remove all single letter or empty lines
-					continue
-				lines.append(line)
-				tokens = tokenizer.tokenize(line)
-				if cap_present:
-					caps = get_caps(run_strip_accents(line), tokens)
-					assert len(tokens) == len(caps)
-					capitalizations.append(caps)
-				if tf_or_idf_present:
-					token_counter.update(tokens)
-				all_tokens.append(tokens)
-		return token_counter, lines, all_tokens, capitalizations
+			self.build_tf_tables(len(tokenizer))
+
+	def build_tf_tables(self, vocab_size):
+		'''
+			TF and TFIDF labels stored sparsely : only the tokens present in a document get an entry. Entries are
+			keyed by doc_idx * vocab_size + token_id and kept sorted so the labels of a batch are one searchsorted.
+			Tokens that do not appear in a document get 0.
+		'''
+		num_docs = len(self.doc_names)
+		self.tf_vocab_size = vocab_size
+		doc_freqs = np.zeros(vocab_size, dtype=np.int64)
+		doc_present, doc_tfs = [], []
+		for doc_idx in range(num_docs):
+			# Get the token frequencies
+			counts = count_ids(self.store.get_doc_ids(doc_idx), vocab_size)
+			present = np.nonzero(counts)[0]
+			doc_present.append(present)
+			if len(present) == 0:
+				doc_tfs.append(np.zeros(0, dtype=np.float32))
+				continue
+			tf_info = scale_array(counts[present], max_=self.max_, smoothfactor=1)
+			values = np.ceil(np.log10(tf_info))
+			# get the minimum value
+			to_add = min(values) * np.sign(min(values)) + 1
+			# This is currently hard-coded to ensure that we have 7 classes. Need to fix
+			doc_tfs.append(np.minimum(values + to_add, 3).astype(np.float32))
+			doc_freqs[present] += 1
+
+		# need to do some idf computation here
+		smoothed_n = 1 + num_docs
+		doc_idfs = np.log(smoothed_n / (1 + doc_freqs) + 1.0)
+		doc_tfidfs = []
+		for present, tf_values in zip(doc_present, doc_tfs):
+			if len(present) == 0:
+				doc_tfidfs.append(np.zeros(0, dtype=np.float32))
+				continue
+			tfidf = tf_values * doc_idfs[present]
+			doc_tfidfs.append(scale_array(tfidf, smoothfactor=1).astype(np.float32))
+		# present is sorted within a doc and docs come in order so the keys are sorted
+		self.tf_keys = np.concatenate(
+							[doc_idx * vocab_size + present for doc_idx, present in enumerate(doc_present)] +
+							[np.zeros(0, dtype=np.int64)]
+					).astype(np.int64)
+		self.doc_tf_values = np.concatenate(doc_tfs + [np.zeros(0, dtype=np.float32)])
+		self.doc_tfidf_values = np.concatenate(doc_tfidfs + [np.zeros(0, dtype=np.float32)])
+
+	def process_single_file(self, file_path):
+		# Same line filtering as the corpus store so line indices agree
+		return [line for _, line in scan_lines(file_path)]
+
+	def compute_caps(self, sent_idxs):
+		'''
+			Capitalization labels (1 if a token covers an upper-case character) for a batch of sentences. With a fast
+			tokenizer these come from the offset mappings of one batched call : a prefix sum over the upper-case
+			characters of a line gives the count inside every token span. Other tokenizers fall back to aligning
+			the tokens with the accent-stripped text.
+		'''
+		lines = [self.examples[idx] for idx in sent_idxs]
+		if not getattr(self.tokenizer, 'is_fast', False):
+			return [np.array(get_caps(run_strip_accents(line), self.tokenizer.tokenize(line)), dtype=bool) for line in lines]
+		encoded = self.tokenizer(lines, add_special_tokens=False, return_offsets_mapping=True)
+		all_caps = []
+		for line, offsets in zip(lines, encoded['offset_mapping']):
+			upper = np.zeros(len(line) + 1, dtype=np.int64)
+			upper[1:] = np.cumsum([char.isupper() for char in line])
+			offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+			all_caps.append((upper[offsets[:, 1]] - upper[offsets[:, 0]]) > 0)
+		return all_caps
+
+	def prefetch_caps(self, sent_idxs):
+		# Computes the CAP labels of all the uncached sentences in one batch. Labels are stored as packed bits
+		missing = list(set([idx for idx in sent_idxs if idx not in self.cap_cache]))
+		if len(missing) > 0:
+			for idx, caps in zip(missing, self.compute_caps(missing)):
+				self.cap_cache[idx] = (len(caps), np.packbits(caps))
+		for idx in sent_idxs:
+			self.cap_cache.move_to_end(idx)
+		while len(self.cap_cache) > max(self.cap_cache_size, len(sent_idxs)):
+			self.cap_cache.popitem(last=False)
+
+	def get_sent_caps(self, sent_idx):
+		assert self.cap_present, 'CAP labels were not requested for this dataset'
+		if sent_idx not in self.cap_cache:
+			self.prefetch_caps([sent_idx])
+		num_tokens, bits = self.cap_cache[sent_idx]
+		self.cap_cache.move_to_end(sent_idx)
+		return np.unpackbits(bits, count=num_tokens)
 
 	def __len__(self):
 		return len(self.examples)
 
 	def __getitem__(self, i):
-		return {'sample': self.examples[i], 'idx': i}
+		return {'sample': self.examples[i], 'idx': i, 'input_ids': self.store.get_ids(i)}
 
 	def get_samples(self, n_samples, is_sent_config=False):
 		total_samples = len(self.examples)
@@ -210,38 +247,41 @@ class LineByLineRawTextDataset(Dataset):
 			all_chosen.extend(second_half)
 		return all_chosen
 
+	def getdocidxs(self, sent_idxs):
+		return np.searchsorted(self.doc_lens, sent_idxs, side="right") - 1
+
 	def getdocid(self, sent_idx):
 		idx = np.searchsorted(self.doc_lens, sent_idx, side="left")
 		if self.doc_lens[idx] > sent_idx:
 			return self.doc_names[idx - 1]
 		return self.doc_names[idx]
 
-	def _pad_specials(self, sent_, special_tok_mask):
-		if len(sent_) == len(special_tok_mask):
-			assert sum(special_tok_mask) > 0, 'Sentence and token mask same length but there are special tokens'
-			return torch.tensor(sent_)
-
-		assert len(sent_) < len(special_tok_mask), 'Sentence must have fewer tokens than the special tokens mask'
-		mul_ = 1.0 if isinstance(sent_[0], float) else 1
-		new_sent_ = torch.full((len(special_tok_mask), ), OUT_PAD * mul_) # We only compute loss on masked tokens
-		for idx_, val_ in enumerate(sent_):
-			new_sent_[idx_ + 1] = val_ # plus 1 because we are skipping the bos token
-		return new_sent_
-
-	def getcaps(self, sent_idx, special_token_mask):
-		return self._pad_specials(self.caps[sent_idx], special_token_mask)
-
-	def gettfs(self, sent_idx, special_token_mask):
-		sent_ = self.tokens[sent_idx]
-		tf_cntr = self.doc_tfs[self.getdocid(sent_idx)]
-		tfs = [tf_cntr[x] for x in sent_]
-		return self._pad_specials(tfs, special_token_mask)
-
-	def gettfidfs(self, sent_idx, special_token_mask):
-		sent_ = self.tokens[sent_idx]
-		tfidf_cntr = self.doc_tfidfs[self.getdocid(sent_idx)]
-		tfidfs = [tfidf_cntr[x] for x in sent_]
-		return self._pad_specials(tfidfs, special_token_mask)
+	def get_cap_labels(self, sent_idxs, out_shape, start, max_len):
+		'''
+			CAP labels of a batch scattered into one [B, L] tensor. Token j of sentence i goes to column start + j
+			and sentences are truncated to max_len tokens, the same way collate lays out the inputs.
+		'''
+		self.prefetch_caps(sent_idxs)
+		caps = [self.get_sent_caps(idx)[:max_len] for idx in sent_idxs]
+		lens = np.array([len(x) for x in caps])
+		rows = np.repeat(np.arange(len(caps)), lens)
+		cols = start + np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+		cap_sent = torch.full(out_shape, OUT_PAD, dtype=torch.long)
+		cap_sent[torch.from_numpy(rows), torch.from_numpy(cols)] = torch.from_numpy(np.concatenate(caps).astype(np.int64))
+		return cap_sent
+
+	def get_tf_labels(self, output_type, sent_idxs, token_ids):
+		# token_ids are the (unmasked) ids of the batch. Labels for the whole batch come from one sorted lookup
+		values = torch.from_numpy(self.doc_tfidf_values if output_type == 'TFIDF' else self.doc_tf_values)
+		keys = torch.from_numpy(self.tf_keys)
+		if len(keys) == 0:
+			return torch.zeros(token_ids.shape, dtype=values.dtype, device=token_ids.device)
+		doc_idxs = torch.from_numpy(self.getdocidxs(sent_idxs)).long()
+		query = doc_idxs[:, None] * self.tf_vocab_size + token_ids.cpu()
+		# Misses land on a neighbouring entry (or one past the end) and are zeroed below
+		pos = torch.searchsorted(keys, query).clamp_(max=len(keys) - 1)
+		labels = values[pos].masked_fill_(keys[pos].ne(query), 0.0)
+		return labels.to(token_ids.device)
 
 class DataOptions(object):
 	def __init__(self, args, tokenizer, data_dict, output_dict):
@@ -275,9 +315,22 @@ class DataOptions(object):
 				dataset = SupervisedDataset(k)
 			else:
 				assert path is not None, 'Invalid data type given. {} : {}'.format(k, v)
-				dataset = LineByLineRawTextDataset(path, tokenizer, tf_or_idf_present, cap_present)
+				dataset = LineByLineRawTextDataset(
+												path, tokenizer, tf_or_idf_present, cap_present,
+												cap_cache_size=args.cap_cache_size, cache_dir=args.corpus_cache_dir,
+												num_workers=args.tokenize_workers, stream=args.stream_corpus
+											)
 			self.id_to_dataset_dict[v] = dataset
 
+	def get_vocab_subset(self, vocab_size):
+		# Sorted ids of the tokens that occur in any of the raw text corpora, plus the special tokens
+		present = np.zeros(vocab_size, dtype=bool)
+		present[self.tokenizer.all_special_ids] = True
+		for ds in self.id_to_dataset_dict.values():
+			if isinstance(ds, LineByLineRawTextDataset):
+				present |= count_ids(ds.store.ids, vocab_size) > 0
+		return np.nonzero(present)[0]
+
 	def get_dataset(self, id_):
 		return self.id_to_dataset_dict[id_]
 
@@ -298,9 +351,6 @@ class DataTransformAndItr(object):
 		self.output_dict = output_dict
 		self.proba = args.mlm_probability
 		self.block_size = args.block_size
-		self.special_token_list = dataoptions.tokenizer.all_special_ids
-		self.special_token_list.remove(dataoptions.tokenizer.mask_token_id)
-		self.special_token_list.remove(dataoptions.tokenizer.unk_token_id)
 
 	def total_iters(self):
 		return int(self.dataOpts.get_total_len() / self.train_batch_size)
@@ -308,36 +358,39 @@ class DataTransformAndItr(object):
 	def apply_in_tform(self, sent, token_probas=None):
 		return mask_tokens(sent, self.dataOpts.tokenizer, self.proba, token_probas)
 
+	def get_special_mask(self, sent):
+		# Special tokens (except <mask> and <unk>) and padding get no token-level labels
+		special_mask = get_label_special_mask(sent, self.dataOpts.tokenizer)
+		return special_mask | sent.eq(self.dataOpts.tokenizer.pad_token_id)
+
+	def get_token_labels(self, output_type, ds, tformed_sent, orig_samples, orig_sent, special_mask):
+		'''
+			Token-level labels (DENOISE, TF, TFIDF, CAP) for a whole batch. orig_sent holds the unmasked ids and
+			special_mask flags the special and padding positions, which get no label.
+		'''
+		if output_type == 'DENOISE':
+			return tformed_sent
+		sent_idxs = np.array([x['idx'] for x in orig_samples])
+		if output_type == 'CAP':
+			prefix, suffix = self.get_special_affixes()
+			max_len = self.block_size - len(prefix) - len(suffix)
+			labels = ds.get_cap_labels(sent_idxs, orig_sent.shape, len(prefix), max_len).to(orig_sent.device)
+		else:
+			# Labels are looked up with the original ids, not the masked ones
+			labels = ds.get_tf_labels(output_type, sent_idxs, orig_sent)
+		return labels.masked_fill_(special_mask, OUT_PAD)
+
 	def apply_out_tform(
 							self, output_type, ds, padded_sent, tformed_sent,
-							orig_samples, is_supervised=False
+							orig_samples, is_supervised=False, orig_sent=None, special_mask=None
 						):
-		if output_type == 'DENOISE':
-			assert padded_sent.shape == tformed_sent.shape, 'Invalid Shapes. Input must have same shape as output'
-			return {'input': padded_sent, 'output': tformed_sent}
-		elif is_supervised:
+		if is_supervised:
 			assert padded_sent.shape[0] == tformed_sent.shape[0], 'Invalid Shapes. Must have same batch size for input and output in supervised setting'
 			return {'input': padded_sent, 'output': tformed_sent}
-		elif output_type == 'TFIDF':
-			tfidf_sent = [ds.gettfidfs(x['idx'], special_tok_mask[id_]) for id_, x in enumerate(orig_samples)]
-			tfidf_sent = pad_sequence(tfidf_sent, OUT_PAD)
-			assert padded_sent.shape == tfidf_sent.shape, 'Invalid Shapes. Input must have same shape as output'
-			return {'input': padded_sent, 'output': tfidf_sent}
-		elif output_type == 'TF':
-			special_tok_mask = sum([padded_sent == x for x in self.special_token_list])
-			special_tok_mask = (special_tok_mask > 0) * 1
-			tf_sent = []
-			for id_, x in enumerate(orig_samples):
-				this_tf_sent = ds.gettfs(x['idx'], special_tok_mask[id_])
-				tf_sent.append(this_tf_sent)
-			tf_sent = torch.stack(tf_sent).to(padded_sent.device)
-			assert padded_sent.shape == tf_sent.shape, 'Invalid Shapes. Input must have same shape as output'
-			return {'input': padded_sent, 'output': tf_sent}
-		elif output_type == 'CAP':
-			cap_sent = [ds.getcaps(x['idx'], special_tok_mask[id_]) for id_, x in enumerate(orig_samples)]
-			cap_sent = pad_sequence(cap_sent, OUT_PAD)
-			assert padded_sent.shape == cap_sent.shape, 'Invalid Shapes. Input must have same shape as output'
-			return {'input': padded_sent, 'output': cap_sent}
+		elif output_type == 'DENOISE' or output_type in ALL_TOKEN_CLASSF:
+			token_labels = self.get_token_labels(output_type, ds, tformed_sent, orig_samples, orig_sent, special_mask)
+			assert padded_sent.shape == token_labels.shape, 'Invalid Shapes. Input must have same shape as output'
+			return {'input': padded_sent, 'output': token_labels}
 		elif  output_type == 'NSP':
 			# Todo[ldery] - implement
 			raise NotImplementedError('This output type [{}] has not been impemented yet'.format(output_type)) 
@@ -420,6 +473,9 @@ class DataTransformAndItr(object):
 	):
 		_, stage_map = searchOpts.config.get_stage_w_name(1)
 		(inputs, labels, masks_for_tformed), supervised_labels = self.collate(examples, token_probas)
+		# inputs were masked in place. The masked positions still have their original ids in labels
+		orig_inputs = torch.where(labels.ne(-100), labels, inputs)
+		special_mask = self.get_special_mask(orig_inputs)
 		pad_mask = 1.0 - (inputs.eq(self.dataOpts.tokenizer.pad_token_id)).float()
 		rep_mask = representation_tform.get_rep_tform(inputs.shape, pad_mask, rep_id)
 		batch = {'input': inputs, 'output': None, 'rep_mask': rep_mask}
@@ -433,17 +489,34 @@ class DataTransformAndItr(object):
 				assert ds.is_supervised, 'We can only have this setting for supervised data'
 				task_output = supervised_labels
 			out_type = searchOpts.config.get_name(3, config_[-1])
-			dict_ = self.apply_out_tform(out_type, ds, inputs, task_output, examples, is_supervised=is_supervised)
+			dict_ = self.apply_out_tform(
+									out_type, ds, inputs, task_output, examples,
+									is_supervised=is_supervised, orig_sent=orig_inputs, special_mask=special_mask
+								)
 			config_dict[config_] = dict_['output']
 		return batch, config_dict
 
+	def get_special_affixes(self):
+		# The special tokens the tokenizer puts before and after a single sequence
+		if not hasattr(self, 'special_affixes'):
+			marker = -1
+			with_specials = self.dataOpts.tokenizer.build_inputs_with_special_tokens([marker])
+			pos = with_specials.index(marker)
+			self.special_affixes = np.array(with_specials[:pos], dtype=np.int64), np.array(with_specials[pos + 1:], dtype=np.int64)
+		return self.special_affixes
+
 	def collate(self, examples, token_probas):
-		all_egs = [x['sample'] for x in examples]
-		out = self.dataOpts.tokenizer.batch_encode_plus(
-								all_egs, add_special_tokens=True, truncation=True,
-								max_length=self.block_size, return_special_tokens_mask=True
-				)
-		all_egs = [torch.tensor(x) for x in out["input_ids"]]
+		if 'input_ids' in examples[0]:
+			# Pre-tokenized : add the special tokens and truncate the same way batch_encode_plus would
+			prefix, suffix = self.get_special_affixes()
+			max_len = self.block_size - len(prefix) - len(suffix)
+			all_egs = [torch.from_numpy(np.concatenate((prefix, x['input_ids'][:max_len], suffix))) for x in examples]
+		else:
+			all_egs = [x['sample'] for x in examples]
+			out = self.dataOpts.tokenizer.batch_encode_plus(
+									all_egs, add_special_tokens=True, truncation=True, max_length=self.block_size
+					)
+			all_egs = [torch.tensor(x) for x in out["input_ids"]]
 		labels = None
 		if 'label' in examples[0]:
 			labels = torch.tensor([x['label'] for x in examples])
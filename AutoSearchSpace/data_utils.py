@@ -1,6 +1,7 @@
 import torch
 import unicodedata
 import numpy as np
+from collections.abc import Mapping
 from torch.nn.utils.rnn import pad_sequence as torch_pad_sequence
 import pdb
 
@@ -13,18 +14,91 @@ def pad_sequence(all_egs, pad_token_id):
 		return torch_pad_sequence(all_egs, batch_first=True, padding_value=pad_token_id)
 
 
+# Special token ids keyed by (tokenizer, device)
+SPECIAL_IDS_CACHE = {}
+
+def get_special_ids(tokenizer, device):
+	key_ = (id(tokenizer), str(device))
+	if key_ not in SPECIAL_IDS_CACHE:
+		# Ask the tokenizer which of its special ids it flags so we match get_special_tokens_mask exactly
+		all_ids = tokenizer.all_special_ids
+		flags = tokenizer.get_special_tokens_mask(all_ids, already_has_special_tokens=True)
+		special_ids = [id_ for id_, flag in zip(all_ids, flags) if flag]
+		SPECIAL_IDS_CACHE[key_] = torch.tensor(special_ids, dtype=torch.long, device=device)
+	return SPECIAL_IDS_CACHE[key_]
+
+
+def get_label_special_ids(tokenizer, device):
+	key_ = (id(tokenizer), str(device), 'labels')
+	if key_ not in SPECIAL_IDS_CACHE:
+		# <mask> and <unk> stand in for real tokens so they keep their token-level labels
+		kept_ids = [tokenizer.mask_token_id, tokenizer.unk_token_id]
+		special_ids = [id_ for id_ in tokenizer.all_special_ids if id_ not in kept_ids]
+		SPECIAL_IDS_CACHE[key_] = torch.tensor(special_ids, dtype=torch.long, device=device)
+	return SPECIAL_IDS_CACHE[key_]
+
+
+def isin(elements, test_elements):
+	if hasattr(torch, 'isin'):
+		return torch.isin(elements, test_elements)
+	# Older versions of torch. The number of special ids is tiny so this stays cheap
+	return (elements[..., None] == test_elements).any(dim=-1)
+
+
+def get_special_tokens_mask(labels, tokenizer):
+	# Tensor version of tokenizer.get_special_tokens_mask(..., already_has_special_tokens=True) for a whole batch
+	return isin(labels, get_special_ids(tokenizer, labels.device))
+
+
+def get_label_special_mask(labels, tokenizer):
+	# Positions that get no token-level (TF / TFIDF / CAP) labels
+	return isin(labels, get_label_special_ids(tokenizer, labels.device))
+
+
 def get_probability_matrix(proba, labels, tokenizer):
-	probability_matrix = torch.full(labels.shape, proba)
-	special_tokens_mask = [
-		tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-	]
-	probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+	probability_matrix = torch.full(labels.shape, proba, device=labels.device)
+	probability_matrix.masked_fill_(get_special_tokens_mask(labels, tokenizer), value=0.0)
 	if tokenizer._pad_token is not None:
 		padding_mask = labels.eq(tokenizer.pad_token_id)
 		probability_matrix.masked_fill_(padding_mask, value=0.0)
 	return probability_matrix
 
 
+# Codes for what happened to each position in mask_tokens
+NOT_MASKED, MASK_CODE, REPLACE_CODE, NONE_CODE = 0, 1, 2, 3
+TFORM_CODES = {'Mask': MASK_CODE, 'Replace': REPLACE_CODE, 'None': NONE_CODE}
+
+
+class TformedLabels(Mapping):
+	'''
+		Per-transform (indices, labels) pairs that share one backing buffer. Every position has a small code saying
+		which transform (if any) it went through. The labels of a transform are only materialized the first time
+		they are looked up. 'BERT' covers every masked position.
+	'''
+	def __init__(self, labels, masked_indices, codes, tform_names):
+		self.labels = labels
+		self.masked_indices = masked_indices
+		self.codes = codes
+		self.tform_names = list(tform_names) + ['BERT']
+		self.views = {}
+
+	def __getitem__(self, name):
+		if name not in self.tform_names:
+			raise KeyError(name)
+		if name == 'BERT':
+			return self.masked_indices, self.labels
+		if name not in self.views:
+			indices = self.codes.eq(TFORM_CODES[name])
+			self.views[name] = (indices, self.labels.masked_fill(~indices, -100))
+		return self.views[name]
+
+	def __iter__(self):
+		return iter(self.tform_names)
+
+	def __len__(self):
+		return len(self.tform_names)
+
+
 def mask_tokens(inputs, tokenizer, proba, token_proba=None):
 	""" Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
 
@@ -32,28 +106,16 @@ def mask_tokens(inputs, tokenizer, proba, token_proba=None):
 		raise ValueError(
 			"This tokenizer does not have a mask token which is necessary for masked language modeling. Remove the --mlm flag if you want to use this tokenizer."
 		)
-	labels = inputs.clone()
-	# We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-	probability_matrix = get_probability_matrix(proba, labels, tokenizer)
-	masked_indices = torch.bernoulli(probability_matrix).bool()
-	labels[~masked_indices] = -100	# We only compute loss on masked tokens
-
 	tk_prob_is_none = token_proba is None
-	tformed_mask_indices = {}
-	indices_replaced, indices_random = None, None
+	tform_names = ['Mask', 'Replace', 'None'] if tk_prob_is_none else [x for x in ['Mask', 'Replace', 'None'] if x in token_proba]
 
-	# x% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-	if tk_prob_is_none or 'Mask' in token_proba:
+	# x% of the masked positions are replaced with tokenizer.mask_token ([MASK])
+	mask_proba = 0.0
+	if 'Mask' in tform_names:
 		mask_proba = 0.8 if tk_prob_is_none else token_proba['Mask']
-		indices_replaced = torch.bernoulli(torch.full(labels.shape, mask_proba)).bool() & masked_indices
-		inputs[indices_replaced] = tokenizer.convert_tokens_to_ids(tokenizer.mask_token)
-
-		mask_output = labels.clone().detach()
-		mask_output[~indices_replaced] = -100
-		tformed_mask_indices['Mask'] = (indices_replaced, mask_output)
-
-	# y% of the time, we replace masked input tokens with random word
-	if tk_prob_is_none or 'Replace' in token_proba:
+	# y% of the remaining masked positions are replaced with a random word
+	replace_proba = 0.0
+	if 'Replace' in tform_names:
 		if tk_prob_is_none:
 			replace_proba = 0.5
 		elif 'None' in token_proba:
@@ -61,32 +123,30 @@ def mask_tokens(inputs, tokenizer, proba, token_proba=None):
 		else:
 			replace_proba = token_proba['Replace']
 
-		indices_random = torch.bernoulli(torch.full(labels.shape, replace_proba)).bool() & masked_indices
-		if indices_replaced is not None:
-			indices_random = indices_random  & ~indices_replaced
-		random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
-		inputs[indices_random] = random_words[indices_random]
-
-		replace_output = labels.clone().detach()
-		replace_output[~indices_random] = -100
-		tformed_mask_indices['Replace'] = (indices_random, replace_output)
-
-	if tk_prob_is_none or 'None' in token_proba:
-
-		used = None
-		if (indices_replaced is not None) and (indices_random is not None):
-			used = ~(indices_replaced | indices_random)
-		elif indices_random is not None:
-			used = ~indices_random
-		elif indices_replaced is not None:
-			used = ~indices_replaced
-
-		indices_none = masked_indices & used if used is not None else masked_indices
-		none_output = labels.clone().detach()
-		none_output[~indices_none] = -100
-		tformed_mask_indices['None'] = (indices_none, none_output)
-	tformed_mask_indices['BERT'] = (masked_indices, labels)
-	return inputs, labels, tformed_mask_indices
+	# We sample a few tokens in each sequence for masked-LM training (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
+	# A single uniform draw decides both whether a position is masked (u < p) and, through u / p which is uniform
+	# on [0, 1) given that it is masked, which transform bucket it falls in.
+	probability_matrix = get_probability_matrix(proba, inputs, tokenizer)
+	uniform = torch.rand(inputs.shape, device=inputs.device)
+	masked_indices = uniform < probability_matrix
+	bucket = uniform / probability_matrix.clamp(min=EPSILON)
+
+	codes = torch.zeros(inputs.shape, dtype=torch.int8, device=inputs.device)
+	mask_threshold = mask_proba
+	replace_threshold = mask_threshold + (1.0 - mask_proba) * replace_proba
+	codes.masked_fill_(masked_indices, NONE_CODE if 'None' in tform_names else NOT_MASKED)
+	codes.masked_fill_(masked_indices & (bucket < replace_threshold), REPLACE_CODE)
+	codes.masked_fill_(masked_indices & (bucket < mask_threshold), MASK_CODE)
+
+	labels = inputs.masked_fill(~masked_indices, -100)	# We only compute loss on masked tokens
+	indices_replaced = codes.eq(MASK_CODE)
+	inputs.masked_fill_(indices_replaced, tokenizer.convert_tokens_to_ids(tokenizer.mask_token))
+	indices_random = codes.eq(REPLACE_CODE)
+	# Random words are only drawn for the positions that are replaced
+	num_random = int(indices_random.sum())
+	if num_random > 0:
+		inputs[indices_random] = torch.randint(len(tokenizer), (num_random,), dtype=torch.long, device=inputs.device)
+	return inputs, labels, TformedLabels(labels, masked_indices, codes, tform_names)
 
 
 
@@ -145,4 +205,39 @@ def scale(counter, min_=0, max_=10, smoothfactor=0):
 	scaling = lambda x: ((max_ - min_) * (x - c_min) / (c_max - c_min + 1e-8)) + min_
 	for k, v in counter.items():
 		new_counter[k] = scaling(v)
-	return new_counter
\ No newline at end of file
+	return new_counter
+
+
+def scale_array(values, min_=0, max_=10, smoothfactor=0):
+	# Same as scale for an array of values
+	c_min = values.min() - smoothfactor
+	c_max = values.max()
+	return ((max_ - min_) * (values - c_min) / (c_max - c_min + 1e-8)) + min_
+
+
+class _ToyTokenizer(object):
+	# Just enough of a HF tokenizer for the tests below. It flags every special id, <unk> and <mask> included
+	bos_token_id, pad_token_id, eos_token_id, unk_token_id, mask_token_id = 0, 1, 2, 3, 4
+	all_special_ids = [0, 2, 3, 1, 4]
+	_pad_token = '<pad>'
+
+	def get_special_tokens_mask(self, token_ids, already_has_special_tokens=False):
+		return [int(id_ in self.all_special_ids) for id_ in token_ids]
+
+
+def test_label_special_mask():
+	try:
+		tokenizer = _ToyTokenizer()
+		sent = torch.tensor([[0, 10, 3, 11, 4, 2, 1]])
+		label_mask = get_label_special_mask(sent, tokenizer)
+		assert label_mask.tolist() == [[True, False, False, False, False, True, True]], '<unk> and <mask> should keep their labels'
+		special_mask = get_special_tokens_mask(sent, tokenizer)
+		assert special_mask.tolist() == [[True, False, True, False, True, True, True]], '<unk> and <mask> should never be masked for MLM'
+		msg = 'Passed.'
+	except:
+		msg = 'Failed.'
+	print("test_label_special_mask : {}".format(msg))
+
+
+if __name__ == '__main__':
+	test_label_special_mask()
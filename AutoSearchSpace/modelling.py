@@ -5,10 +5,10 @@ from allennlp.modules import FeedForward
 from transformers import (
 	AutoModel,
 	AdamW,
-	AutoConfig,
 )
 from tqdm import tqdm, trange
 from transformers.models.roberta.modeling_roberta import RobertaLMHead
+from transformers.activations import gelu
 from allennlp.data import Vocabulary
 from collections import defaultdict
 import numpy as np
@@ -19,6 +19,9 @@ import os
 import sys
 import gc
 import math
+import time
+
+from representation_mask import RepMask, expand_rep_mask
 
 PATH = os.path.join(os.getcwd(), "dont_stop_pretraining/")
 
@@ -60,10 +63,17 @@ def calc_norm(grads):
 def get_body_end(model):
 	pos = 0
 	for k, _ in model.named_parameters():
-		if '_text_field_embedder' in k:
+		# The body's LM head is an output head (shared by the denoising configs), not part of the body
+		if '_text_field_embedder' in k and '.lm_head.' not in k:
 			pos += 1
 	return pos
 
+def get_timestamp(sync):
+	# Kernels run asynchronously so the device has to be synced for wall-clock timings to be meaningful
+	if sync and torch.cuda.is_available():
+		torch.cuda.synchronize()
+	return time.time()
+
 # For collating data
 def collate(examples, pad_token_id):
 	return pad_sequence(examples, batch_first=True, padding_value=pad_token_id)
@@ -107,17 +117,71 @@ def add_modelling_options(parser):
 	parser.add_argument("--classf_ft_lr", type=float, default=2e-6, help="Learning rate of classifier for finetuning")
 	parser.add_argument("--dev_fit_iters", type=int, default=10, help="Number of iterations to run fitting dev head")
 	parser.add_argument("--share-output-heads", action='store_true')
+	parser.add_argument("--separate-lm-heads", action='store_true', help='Give every denoising config its own copy of the LM head')
+	parser.add_argument("--lm-adapter-rank", type=int, default=0, help='Rank of the per-config adapter in front of the shared LM head. 0 disables it')
+	parser.add_argument("--lm-config-bias", action='store_true', help='Learn a per-config vocabulary bias on top of the shared LM head')
+	parser.add_argument("--restrict-lm-vocab", action='store_true', help='Denoising heads only score the tokens that occur in the aux corpora')
+	parser.add_argument("--lm-vocab-negatives", type=int, default=0, help='Tokens sampled from the full vocabulary and scored in addition to the restricted vocabulary')
+	parser.add_argument("--min-aux-scaling", type=float, default=0.0, help="Aux configs whose loss scaling is below this are not run")
 	return parser
 
 import pdb
 class ModelWithLMHead(nn.Module):
-	def __init__(self, base_model, model_name):
+	'''
+		Denoising head. By default every config uses the body's LM head, whose decoder is tied to the input
+		embeddings, and only owns an optional low-rank adapter on the hidden states and an optional vocabulary
+		bias. With separate_head every config gets its own copy of the LM head instead.
+	'''
+	def __init__(self, base_model, separate_head=False, adapter_rank=0, config_bias=False):
 		super().__init__()
 		self._text_field_embedder = base_model
-		config = AutoConfig.from_pretrained(model_name)
-		self.lm_head = RobertaLMHead(config)
 		self._loss = torch.nn.CrossEntropyLoss(reduction='none')
-		self.copy_base_lm_head(base_model)
+		self.separate_head = separate_head
+		if separate_head:
+			self.lm_head = RobertaLMHead(base_model.config)
+			self.copy_base_lm_head(base_model)
+		hidden_size, vocab_size = base_model.config.hidden_size, base_model.config.vocab_size
+		self.adapter = None
+		if adapter_rank > 0:
+			self.adapter = nn.Sequential(
+									nn.Linear(hidden_size, adapter_rank, bias=False),
+									nn.Linear(adapter_rank, hidden_size, bias=False)
+							)
+			# Starts out as the identity so the config initially predicts exactly like the shared head
+			nn.init.zeros_(self.adapter[1].weight)
+		self.vocab_bias = nn.Parameter(torch.zeros(vocab_size)) if config_bias else None
+		# Sorted token ids the softmax is restricted to. None means the full vocabulary is scored
+		self.register_buffer('vocab_subset', None, persistent=False)
+		self.num_negatives = 0
+
+	def get_lm_head(self):
+		# The shared head is looked up through the body so it follows it across devices and reloads
+		return self.lm_head if self.separate_head else self._text_field_embedder.lm_head
+
+	def set_vocab_subset(self, vocab_subset, num_negatives=0):
+		self.vocab_subset = vocab_subset
+		self.num_negatives = num_negatives
+
+	def get_vocab_idxs(self, labels):
+		if self.vocab_subset is None:
+			return None
+		# Labels outside the subset (e.g from corpora it was not built from) are always scored. Negatives are drawn
+		# from the whole vocabulary so the tokens outside the subset still get pushed down now and then
+		candidates = [self.vocab_subset, labels]
+		if self.num_negatives > 0:
+			vocab_size = self.get_lm_head().decoder.weight.shape[0]
+			candidates.append(torch.randint(vocab_size, (self.num_negatives, ), device=labels.device))
+		return torch.unique(torch.cat(candidates))
+
+	def project(self, hidden, vocab_idxs=None):
+		lm_head = self.get_lm_head()
+		if vocab_idxs is None:
+			logits = lm_head(hidden)
+			return logits if self.vocab_bias is None else logits + self.vocab_bias
+		# Same as RobertaLMHead.forward with the decoder restricted to the rows in vocab_idxs
+		features = lm_head.layer_norm(gelu(lm_head.dense(hidden)))
+		logits = nn.functional.linear(features, lm_head.decoder.weight[vocab_idxs], lm_head.bias[vocab_idxs])
+		return logits if self.vocab_bias is None else logits + self.vocab_bias[vocab_idxs]
 
 	def copy_base_lm_head(self, base_model):
 		with torch.no_grad():
@@ -134,8 +198,20 @@ class ModelWithLMHead(nn.Module):
 		else:
 			mask = None
 			embedded_text = embedded_text[1][-1]
-		logits = self.lm_head(embedded_text)
-		loss = self._loss(logits.view(-1, logits.shape[-1]), labels.long().view(-1))
+		# Only positions with a label are projected to the vocabulary. Their losses are put back in a B*L vector
+		labels = labels.long().view(-1)
+		active = labels.ne(self._loss.ignore_index)
+		hidden = embedded_text.reshape(-1, embedded_text.shape[-1])[active]
+		if self.adapter is not None:
+			hidden = hidden + self.adapter(hidden)
+		active_labels = labels[active]
+		vocab_idxs = self.get_vocab_idxs(active_labels)
+		if vocab_idxs is not None:
+			# Labels become positions in the restricted vocabulary
+			active_labels = torch.searchsorted(vocab_idxs, active_labels)
+		logits = self.project(hidden, vocab_idxs)
+		active_loss = self._loss(logits, active_labels)
+		loss = torch.zeros(labels.shape, dtype=active_loss.dtype, device=active_loss.device).masked_scatter(active, active_loss)
 		output_dict = {}
 		output_dict["loss_full"] = loss
 		num_active = len(loss.nonzero())
@@ -195,6 +271,7 @@ class ModelWithAuxTasks(AutoModel):
 		self.max_norm = 10.0
 		self.max_seq_len = max_seq_len
 		self.grad_accum_factor = grad_accum_factor
+		self.min_aux_scaling = args.min_aux_scaling
 		# Save grads of auxiliary losses
 		self.auxloss_cosines = defaultdict(list)
 		self.dev_batch_sz = dev_batch_sz # Batch Size for dev-set
@@ -267,11 +344,9 @@ class ModelWithAuxTasks(AutoModel):
 		self.setup_classifier(dropout, self.primary_task_info['prim_task_id'], vocab, embedding_dim, ff_multiplier, num_layers=num_layers)
 		# Setup the other outputs here
 		for aux_loss_config in searchOpts.get_valid_configs():
-			key_ = ".".join([str(x) for x in aux_loss_config])
-			if self.share_output_heads:
-				key_ = str(aux_loss_config[-1])
-				if key_ in self.head_list:
-					continue
+			key_ = self.get_head_key(aux_loss_config)
+			if self.share_output_heads and (key_ in self.head_list):
+				continue
 			if searchOpts.is_tokenlevel(aux_loss_config[-1]):
 				# We are doing token level classification here
 				vocab_tokens, is_lm = searchOpts.is_tokenlevel_lm(aux_loss_config[-1])
@@ -280,7 +355,10 @@ class ModelWithAuxTasks(AutoModel):
 					vocab.add_tokens_to_namespace(vocab_tokens, namespace='labels')
 					self.setup_seq_tagger(dropout, key_, vocab, embedding_dim, ff_multiplier, num_layers=1, num_labels=len(vocab_tokens))
 				else:
-					this_model = ModelWithLMHead(self.base_model, self.model_name)
+					this_model = ModelWithLMHead(
+										self.base_model, separate_head=self.options.separate_lm_heads,
+										adapter_rank=self.options.lm_adapter_rank, config_bias=self.options.lm_config_bias
+								)
 					setattr(self, 'AuxHead-{}'.format(key_), this_model)
 			elif searchOpts.is_dot_prod(aux_loss_config[-1]):
 				self.setup_sent_classifier(dropout, key_, embedding_dim, ff_multiplier)
@@ -343,6 +421,40 @@ class ModelWithAuxTasks(AutoModel):
 		setattr(self, 'AuxHead-{}'.format(task_idx), classifier)
 		return classifier
 
+	def set_lm_vocab_subset(self, vocab_subset, num_negatives=0):
+		# Denoising heads only score these token ids, the labels of the batch and num_negatives sampled tokens
+		vocab_subset = torch.as_tensor(vocab_subset, dtype=torch.long, device=self.base_model.device)
+		for key in self.head_list:
+			this_head = getattr(self, "AuxHead-{}".format(key), None)
+			if isinstance(this_head, ModelWithLMHead):
+				this_head.set_vocab_subset(vocab_subset, num_negatives=num_negatives)
+
+	def get_head_key(self, aux_loss_config):
+		return ".".join([str(x) for x in aux_loss_config]) if not self.share_output_heads else str(aux_loss_config[-1])
+
+	def remove_heads(self, aux_loss_configs, searchOpts, optimizer=None):
+		'''
+			Frees the heads of configs that have been pruned from the search along with their optimizer state.
+			Shared output heads are only freed once no remaining config uses them.
+		'''
+		in_use = set([self.get_head_key(config_) for config_ in searchOpts.get_valid_configs()])
+		in_use.add(self.primary_task_info['prim_task_id'])
+		keys = set([self.get_head_key(config_) for config_ in aux_loss_configs]) - in_use
+		keys = [key for key in keys if key in self.head_list]
+		if len(keys) == 0:
+			return
+		removed = set([id(param) for param in self.get_classifier_params(keys=keys)])
+		if optimizer is not None:
+			for group in optimizer.param_groups:
+				group['params'] = [param for param in group['params'] if id(param) not in removed]
+			for param in list(optimizer.state.keys()):
+				if id(param) in removed:
+					del optimizer.state[param]
+		for key in keys:
+			delattr(self, 'AuxHead-{}'.format(key))
+			self.head_list.remove(key)
+		torch.cuda.empty_cache()
+
 	def get_classifier_params(self, keys=None, withbase=False):
 		param_list = []
 		# Get all the classifier params if keys is not specified
@@ -622,7 +734,8 @@ class ModelWithAuxTasks(AutoModel):
 				p.grad.add_(g * scaling)
 
 	# At the end of this, all the model gradients should be populated appropriately 
-	def get_grads_with_auxiliaries(self, aux_config_w_batch, searchOpts, total_batch_size):
+	def get_grads_with_auxiliaries(self, aux_config_w_batch, searchOpts, total_batch_size, importance_weights=None):
+		# importance_weights maps each sampled config to its correction weight when configs were not sampled uniformly
 		# Todo [Try to do a step through for this code to determine if things are working properly]
 		this_head = None
 		if not hasattr(self, 'body_params_end'):
@@ -634,9 +747,10 @@ class ModelWithAuxTasks(AutoModel):
 		dev_norm = calc_norm(dev_head_grads) + EPS # Adding this to prevent possible NAN here
 		dev_info = dev_head_grads, dev_norm
 		
-		# Get the task weighting parameters
-		all_aux_weights, prim_weight, aux_weight = searchOpts.get_weighttensor_nograd()
-		all_aux_weights_raw, prim_raw, aux_raw = searchOpts.get_weighttensor_nograd(softmax=False)
+		# Get the task weighting parameters. These are cached by searchOpts until the next weight update
+		_, prim_weight, aux_weight = searchOpts.get_weighttensor_nograd()
+		_, prim_raw, aux_raw = searchOpts.get_weighttensor_nograd(softmax=False)
+		aux_weight_value = aux_weight.item()
 
 		# Get all the relevant primary task info
 		loss_config = self.primary_task_info['prim_task_id']
@@ -657,17 +771,35 @@ class ModelWithAuxTasks(AutoModel):
 		# Get all the auxiliary configurations
 		all_aux_configs = [k for b_, conf_ in aux_config_w_batch for k, v in conf_.items()]
 		# Out relative because we do not further split the data based on the output since this would require too many samples.
-		all_aux_probas = searchOpts.get_all_and_out_relative(all_aux_configs)
+		# This is computed in one batched softmax on device and only copied to host once, on the first lookup below.
+		all_aux_probas = searchOpts.get_all_and_out_relative(all_aux_configs, importance_weights=importance_weights)
+		all_aux_weights = searchOpts.get_config_weights(all_aux_configs)
+		all_aux_weights_raw = searchOpts.get_config_weights(all_aux_configs, softmax=False)
 		for batch, config_dict in aux_config_w_batch:
+			with torch.no_grad():
+				base_scaling = batch['input'].shape[0] / (total_batch_size * 1.0)  # Weighting based on non-(output and task-unique) weightings
+				base_scaling = base_scaling * (aux_weight_value / self.grad_accum_factor)
+			# Configs whose loss would be scaled to (almost) nothing skip their forward and backward passes
+			active_configs = [
+								(config_, output_) for config_, output_ in config_dict.items()
+								if base_scaling * all_aux_probas[config_] >= self.min_aux_scaling
+							]
+			if len(active_configs) == 0:
+				continue
+			body_start = get_timestamp(searchOpts.track_costs)
 			for k, v in batch.items():
-				if isinstance(v, torch.Tensor):
+				if isinstance(v, (torch.Tensor, RepMask)):
 					batch[k] = v.cuda()
-			embedded_text = self.base_model(batch['input'], attention_mask=batch['rep_mask'])
+			# Structured rep masks only move their padding vector and are expanded on device here
+			embedded_text = self.base_model(batch['input'], attention_mask=expand_rep_mask(batch['rep_mask']))
+			# The body forward is shared by the configs of this batch so each is charged an equal part of it
+			body_share = (get_timestamp(searchOpts.track_costs) - body_start) / len(active_configs)
 
 			# Now treat each of the losses in the config dictionary
-			for config_idx, (aux_loss_config, task_output) in enumerate(config_dict.items()):
+			for config_idx, (aux_loss_config, task_output) in enumerate(active_configs):
+				config_start = get_timestamp(searchOpts.track_costs)
 				human_readable = searchOpts.get_config_human_readable(aux_loss_config)
-				task_id = ".".join([str(x) for x in aux_loss_config]) if not self.share_output_heads else str(aux_loss_config[-1])
+				task_id = self.get_head_key(aux_loss_config)
 				batch['output'] = task_output.cuda()
 				
 				if searchOpts.config.get_name(3, aux_loss_config[-1]) == searchOpts.config.get_name(0, aux_loss_config[0]):
@@ -677,10 +809,11 @@ class ModelWithAuxTasks(AutoModel):
 
 				task_out, task_head = self.run_task(task_id, batch, embedded_text=embedded_text)
 
-				is_not_last = config_idx != (len(config_dict) - 1)
+				is_not_last = config_idx != (len(active_configs) - 1)
+				grad_scale = 1.0 if importance_weights is None else importance_weights[aux_loss_config]
 				aux_grads = self.compute_task_weight_gradients(
 													task_out['loss'], task_head, dev_info, aux_loss_config,
-													searchOpts, is_prim=False, retain_graph=is_not_last
+													searchOpts, is_prim=False, retain_graph=is_not_last, grad_scale=grad_scale
 							)
 				this_grads = aux_grads[:self.body_params_end]
 				num_active = len(task_out['loss_full'].nonzero())
@@ -695,15 +828,15 @@ class ModelWithAuxTasks(AutoModel):
 
 				# Now back-prop
 				with torch.no_grad():
-					aux_scaling = batch['input'].shape[0]/ (total_batch_size * 1.0)  # Weighting based on non-(output and task-unique) weightings 
-					aux_scaling = aux_scaling * (aux_weight / self.grad_accum_factor).item()
-					aux_scaling *= all_aux_probas[aux_loss_config]  # apply the likelihood of an independent loss and output
+					aux_scaling = base_scaling * all_aux_probas[aux_loss_config]  # apply the likelihood of an independent loss and output
 					aux_scaling = 0.0 if task_out['loss'] == 0 else aux_scaling
 				self.apply_gradients(aux_grads, task_head.parameters(), scaling=aux_scaling)
+				if searchOpts.track_costs:
+					searchOpts.record_config_cost(aux_loss_config, body_share + get_timestamp(True) - config_start)
 
 				# Cache results for visualization
-				this_weight = all_aux_weights[aux_loss_config[0], aux_loss_config[1], aux_loss_config[2], aux_loss_config[3]].item()
-				raw_weight = all_aux_weights_raw[aux_loss_config[0], aux_loss_config[1], aux_loss_config[2], aux_loss_config[3]].item()
+				this_weight = all_aux_weights[aux_loss_config]
+				raw_weight = all_aux_weights_raw[aux_loss_config]
 				self.config_losses_and_weights[human_readable].append((task_out['loss'].item(), this_weight, raw_weight))
 				num_aux += 1
 				aux_total_loss += task_out['loss'].item()
@@ -715,8 +848,9 @@ class ModelWithAuxTasks(AutoModel):
 		if torch.isnan(torch.tensor([cos_sim])):
 			pdb.set_trace()
 		searchOpts.update_grad('auxiliary', -cos_sim)
-		self.weight_stats['auxiliary'].append((dev_norm.item(), (aux_norm.item() / all_aux_pts), cos_sim))
-		self.config_losses_and_weights['auxiliary'].append((aux_total_loss / num_aux, aux_weight.item(), aux_raw.item()))
+		# Every sampled config can have been skipped for having a negligible scaling
+		self.weight_stats['auxiliary'].append((dev_norm.item(), (aux_norm.item() / max(all_aux_pts, 1)), cos_sim))
+		self.config_losses_and_weights['auxiliary'].append((aux_total_loss / max(num_aux, 1), aux_weight_value, aux_raw.item()))
 		for stage in range(searchOpts.config.num_stages()):
 			relative_probas = searchOpts.get_relative_probas(stage, None, w_names=True)
 			for k, v in relative_probas.items():
@@ -727,17 +861,17 @@ class ModelWithAuxTasks(AutoModel):
 		this_head = getattr(self, "AuxHead-{}".format(task_id), None)
 		assert this_head is not None, 'Auxiliary Classifier {} not found'.format(task_id)
 		for k, v in batch.items():
-			if isinstance(v, torch.Tensor):
+			if isinstance(v, (torch.Tensor, RepMask)):
 				batch[k] = v.cuda()
 		input_, output_, rep_mask = batch['input'], batch['output'], batch['rep_mask']
 		if embedded_text:
 			model_out = this_head(input_, output_, embedded_text=embedded_text, attn_mask=rep_mask)
 		else:
-			model_out = this_head(input_, output_, attn_mask=rep_mask)
+			model_out = this_head(input_, output_, attn_mask=expand_rep_mask(rep_mask))
 		return model_out, this_head
 
 
-	def compute_task_weight_gradients(self, loss_, task_head, dev_info, loss_config, searchOpts, is_prim=False, retain_graph=True):
+	def compute_task_weight_gradients(self, loss_, task_head, dev_info, loss_config, searchOpts, is_prim=False, retain_graph=True, grad_scale=1.0):
 		task_desc = searchOpts.get_config_human_readable(loss_config) if not is_prim else loss_config
 
 		dev_head_grads, dev_norm = dev_info
@@ -760,8 +894,8 @@ class ModelWithAuxTasks(AutoModel):
 					if grad_ is not None:
 						grad_.mul_(ratio)
 
-		# Save the cosine similarity as the gradient
-		cos_sim = cos_sim / self.grad_accum_factor
+		# Save the cosine similarity as the gradient. grad_scale is the importance weight of a non-uniformly sampled config
+		cos_sim = (cos_sim * grad_scale) / self.grad_accum_factor
 		self.per_param_dp[task_desc].append(per_param_dp)
 		searchOpts.update_grad(loss_config, -cos_sim)
 		if torch.isnan(torch.tensor([cos_sim])):
@@ -1,12 +1,120 @@
+import abc
 import torch
 
+class RepMask(abc.ABC):
+	'''
+		Structured attention mask. Only the padding vector (padding_mask should have 1 in indices that are
+		not padding) and what is needed to rebuild the pattern are stored, so the mask is O(B*L) when it is
+		built and moved between devices. expand() materializes the dense [B, L, L] mask on the padding
+		vector's device.
+	'''
+	def __init__(self, padding_mask, rep_tform):
+		self.padding_mask = padding_mask
+		self.rep_tform = rep_tform
+
+	@property
+	def shape(self):
+		bsz, seq_len = self.padding_mask.shape
+		return (bsz, seq_len, seq_len)
+
+	@abc.abstractmethod
+	def to(self, device):
+		pass
+
+	def cuda(self):
+		return self.to(torch.device('cuda'))
+
+	@abc.abstractmethod
+	def expand(self):
+		pass
+
+
+class CausalMask(RepMask):
+	# Left-To-Right (causal) and Right-To-Left masks built from a triangle cached per sequence length
+	def __init__(self, padding_mask, causal, rep_tform):
+		super().__init__(padding_mask, rep_tform)
+		self.causal = causal  # True for Left-To-Right, False for Right-To-Left
+
+	def to(self, device):
+		return CausalMask(self.padding_mask.to(device, non_blocking=True), self.causal, self.rep_tform)
+
+	def expand(self):
+		seq_len = self.padding_mask.shape[-1]
+		tril = self.rep_tform.get_tril(seq_len, self.padding_mask.device, self.padding_mask.dtype)
+		if self.causal:
+			# Padded positions attend to nothing
+			return tril[None, :, :] * self.padding_mask[:, :, None]
+		# Nothing attends to padded positions
+		return tril.T[None, :, :] * self.padding_mask[:, None, :]
+
+
+class PermutationMask(RepMask):
+	'''
+		Random-Factorized mask (XLNet style) : every example gets its own factorization order and a position
+		attends to the positions that come strictly before it in that order. The order is kept as a [B, L]
+		rank vector drawn on the device the mask is expanded on. Padding always comes last in the order.
+	'''
+	def __init__(self, padding_mask, rep_tform, rank=None):
+		super().__init__(padding_mask, rep_tform)
+		self.rank = rank
+
+	def to(self, device):
+		rank = None if self.rank is None else self.rank.to(device, non_blocking=True)
+		return PermutationMask(self.padding_mask.to(device, non_blocking=True), self.rep_tform, rank=rank)
+
+	def get_rank(self):
+		if self.rank is None:
+			self.rank = self.rep_tform.draw_ranks(self.padding_mask)
+		return self.rank
+
+	def expand(self):
+		rank = self.get_rank()
+		mask = (rank[:, None, :] < rank[:, :, None]).to(self.padding_mask.dtype)
+		# Padded positions attend to nothing
+		return mask * self.padding_mask[:, :, None]
+
+
+def expand_rep_mask(rep_mask):
+	# The body only accepts dense masks
+	return rep_mask.expand() if isinstance(rep_mask, RepMask) else rep_mask
+
+
 # Note [ldery] - tested out in python console
 # Might need to do more extensive tests if the need arises
 class RepTransform(object):
-	def __init__(self, rep_dict):
+	def __init__(self, rep_dict, seed=None):
 		self.rep_dict = rep_dict
-	
-	def get_rep_tform(self, input_shape, padding_mask, rep_tform_idx, sparsity=0.6):
+		# Lower triangular matrices keyed by (sequence length, device, dtype)
+		self.tril_cache = {}
+		# One generator per device for the factorization orders so runs are reproducible given the seed
+		self.seed = seed
+		self.generators = {}
+
+	def get_tril(self, seq_len, device, dtype=torch.float):
+		key_ = (seq_len, str(device), dtype)
+		if key_ not in self.tril_cache:
+			self.tril_cache[key_] = torch.tril(torch.ones(seq_len, seq_len, device=device, dtype=dtype))
+		return self.tril_cache[key_]
+
+	def get_generator(self, device):
+		key_ = str(device)
+		if key_ not in self.generators:
+			generator = torch.Generator(device=device)
+			if self.seed is not None:
+				generator.manual_seed(self.seed)
+			else:
+				generator.seed()
+			self.generators[key_] = generator
+		return self.generators[key_]
+
+	def draw_ranks(self, padding_mask):
+		# Random sort keys in [0, 1) for real tokens and in [2, 3) for padding so padding is sorted last
+		device = padding_mask.device
+		keys = torch.rand(padding_mask.shape, generator=self.get_generator(device), device=device)
+		keys = keys + 2.0 * (padding_mask == 0).to(keys.dtype)
+		return keys.argsort(dim=-1).argsort(dim=-1)
+
+	def get_rep_tform(self, input_shape, padding_mask, rep_tform_idx):
 		'''
 			padding_mask should have 1 in indices that are not padding
 		'''
@@ -15,16 +123,9 @@ class RepTransform(object):
 		if rep_name == 'None':
 			return None
 		elif rep_name == 'Left-To-Right' or rep_name == 'Right-To-Left':
-			left_to_right = torch.tril(torch.ones(input_shape[-1], input_shape[-1]))  # Along the sequence dimension
-			right_to_left = left_to_right.T
-			if rep_name == 'Left-To-Right':
-				return left_to_right[None, :, :] * padding_mask[:, :, None]
-			else:
-				return right_to_left[None, :, :] * padding_mask[:, None, :]
+			return CausalMask(padding_mask, rep_name == 'Left-To-Right', self)
 		elif rep_name == 'Random-Factorized':
-			# Todo [ldery] - there might be rows that are all zeros. Check if this causes an error
-			rand_matrix = torch.FloatTensor(input_shape[-1], input_shape[-1]).uniform_() > (1 - sparsity)
-			rand_matrix = rand_matrix * (1.0 - torch.eye(input_shape[-1]))
-			return rand_matrix[None, :, :] * padding_mask[:, :, None]
+			# The first token in an order attends to nothing. The body treats such rows as uniform attention
+			return PermutationMask(padding_mask, self)
 		else:
 			raise ValueError('Invalid Representation Transform Name given')
@@ -5,6 +5,17 @@ from config import Config
 from torch.optim import SGD, Adam
 import math
 import os
+import tempfile
+from collections.abc import Mapping
+from searchspace_options import ALL_TOKEN_CLASSF, ALL_SENT_CLASSF_OUTPUTS, ALL_SUPERVISED_OUTPUTS, ALL_SENT_DOT_OUTPUTS
+
+# dense   : weights['all'] and the mask span the full product of stage sizes
+# compact : one logit per valid configuration in a flat vector, plus 1-D per-stage vectors
+WEIGHT_STORAGE_CHOICES = ['dense', 'compact']
+# uniform     : every valid config is equally likely to be sampled
+# gumbel-topk : configs are drawn without replacement in proportion to their current joint weight
+# cost-aware  : configs are drawn in proportion to expected meta-gradient utility per unit of compute
+CONFIG_SAMPLER_CHOICES = ['uniform', 'gumbel-topk', 'cost-aware']
 
 def add_searchspace_args(parser):
 	parser.add_argument('-prim-aux-lr', type=float, default=1e-4)
@@ -16,6 +27,19 @@ def add_searchspace_args(parser):
 	parser.add_argument('-token_temp', type=float, default=1.0)
 	parser.add_argument('-warmstart-path', type=str, default=None)
 	parser.add_argument('-pure-transform', action='store_true')
+	parser.add_argument('-weight-storage', type=str, default='dense', choices=WEIGHT_STORAGE_CHOICES)
+	parser.add_argument('-config-sampler', type=str, default='uniform', choices=CONFIG_SAMPLER_CHOICES)
+	# With adaptive sampling, -num-config-samples is the maximum number of configs sampled in a step
+	parser.add_argument('-adaptive-config-samples', action='store_true')
+	parser.add_argument('-min-config-samples', type=int, default=2)
+	parser.add_argument('-config-samples-tol', type=float, default=0.25)
+	parser.add_argument('-config-samples-budget', type=float, default=None, help='Average compute per step, in configs of average estimated cost')
+	# Every -prune-every steps, configs whose joint probability has been under -prune-threshold for
+	# -prune-patience checks in a row are dropped from the search. 0 disables pruning
+	parser.add_argument('-prune-every', type=int, default=0)
+	parser.add_argument('-prune-threshold', type=float, default=1e-4)
+	parser.add_argument('-prune-patience', type=int, default=3)
+	parser.add_argument('-step-time-budget', type=float, default=None, help='Seconds of auxiliary work per step (cost-aware sampler)')
 
 
 def create_tensor(shape, init=0.0, requires_grad=True, is_cuda=True):
@@ -26,13 +50,135 @@ def create_tensor(shape, init=0.0, requires_grad=True, is_cuda=True):
 		weights.requires_grad = True
 	return weights
 
+class ConfigProbas(Mapping):
+	'''
+		Relative probabilities for a list of configs. The values stay on the weights' device
+		as a tensor and are only copied to the host, all at once, the first time a config is looked up.
+	'''
+	def __init__(self, configs, probas):
+		self.configs = configs
+		self.tensor = probas
+		self._dict = None
+
+	def as_dict(self):
+		if self._dict is None:
+			self._dict = dict(zip(self.configs, self.tensor.tolist()))
+		return self._dict
+
+	def __getitem__(self, config):
+		return self.as_dict()[config]
+
+	def __iter__(self):
+		return iter(self.configs)
+
+	def __len__(self):
+		return len(self.configs)
+
+
+def config_to_str(config, stage_config):
+	name_ = ''
+	for stage_id in range(len(config)):
+		stage_name, ids_ = stage_config.get_stage_w_name(stage_id)
+		stage_ = "{}={}".format(stage_name, ids_[config[stage_id]])
+		name_ = "{}|{}".format(name_, stage_) if len(name_) else stage_
+	return name_
+
+
+class ConfigTable(object):
+	'''
+		Table of the valid configurations. The flat id of a config is its row in `configs`.
+		Also holds the raveled (dense) ids of each config, the cached human-readable names and
+		the reverse maps from config tuples and names back to flat ids. Every entry is materialized,
+		in both storage modes, so memory grows with the number of valid configs.
+	'''
+	def __init__(self, config, valid_configurations, all_dims, device):
+		num_stages = config.num_stages()
+		self.configs = np.array(valid_configurations, dtype=np.int64).reshape(-1, num_stages)
+		self.tensor = torch.from_numpy(self.configs).to(device)
+		# Row-major strides over the stage product. Valid configs are enumerated in lexicographic
+		# order so their raveled ids are sorted and can be searched on device.
+		strides = np.cumprod([1] + list(all_dims)[::-1])[:-1][::-1].copy()
+		self.strides = torch.tensor(strides, dtype=torch.long, device=device)
+		self.ravel_ids = (self.tensor * self.strides).sum(dim=-1)
+		self.tuples = list(valid_configurations)
+		self.names = [config_to_str(config_, config) for config_ in valid_configurations]
+		self.id_of = {config_: idx for idx, config_ in enumerate(valid_configurations)}
+		self.id_of_name = {name: idx for idx, name in enumerate(self.names)}
+
+	def __len__(self):
+		return len(self.names)
+
+	def ids(self, configs):
+		return np.array([self.id_of[config_] for config_ in configs], dtype=np.int64)
+
+	def ids_from_tensor(self, config_idxs):
+		ravel_ids = (config_idxs * self.strides).sum(dim=-1)
+		return torch.searchsorted(self.ravel_ids, ravel_ids)
+
+
+class ConfigCostModel(object):
+	'''
+		Per-config compute cost. Each config starts from a FLOP estimate of its body and head work and this is
+		replaced by a moving average of its measured time once it has been run. Unmeasured configs are put in
+		seconds by scaling their estimate with the median measured-to-estimated ratio.
+	'''
+	def __init__(self, config, config_table, seq_len=512, hidden_size=768, num_layers=12, vocab_size=50265, mask_proba=0.15, decay=0.9):
+		self.seq_len, self.hidden_size = seq_len, hidden_size
+		self.num_layers, self.vocab_size = num_layers, vocab_size
+		self.mask_proba = mask_proba
+		self.decay = decay
+		self.estimates = np.array([self.estimate_flops(config, config_) for config_ in config_table.configs.tolist()])
+		self.measured = np.full(len(config_table), np.nan)
+
+	def estimate_flops(self, config, config_):
+		# Forward flops per example. The backward pass roughly doubles both terms so it does not change the ratios.
+		# Configs that share a body forward in a batch are each charged the full body in this estimate.
+		hidden, tokens = self.hidden_size, self.seq_len
+		body = 24 * self.num_layers * (hidden ** 2) * tokens
+		out_name = config.get_name(config.num_stages() - 1, config_[-1])
+		if out_name in ALL_TOKEN_CLASSF:
+			head = 2 * hidden * (hidden + ALL_TOKEN_CLASSF[out_name]) * tokens
+		elif out_name in ALL_SENT_CLASSF_OUTPUTS:
+			head = 2 * hidden * (hidden + ALL_SENT_CLASSF_OUTPUTS[out_name])
+		elif out_name in ALL_SUPERVISED_OUTPUTS:
+			head = 2 * hidden * (hidden + ALL_SUPERVISED_OUTPUTS[out_name])
+		elif out_name == 'DENOISE':
+			# The LM decoder only runs over the masked positions
+			head = 2 * hidden * (hidden + self.vocab_size) * tokens * self.mask_proba
+		elif out_name in ALL_SENT_DOT_OUTPUTS:
+			# A sentence and a token hidden x hidden feedforward. The token one runs over every position
+			head = 2 * 2 * hidden * hidden * tokens
+		else:
+			raise ValueError('No cost estimate for output : {}'.format(out_name))
+		return float(body + head)
+
+	def update(self, config_id, seconds):
+		if np.isnan(self.measured[config_id]):
+			self.measured[config_id] = seconds
+		else:
+			self.measured[config_id] = self.decay * self.measured[config_id] + (1 - self.decay) * seconds
+
+	def costs(self):
+		'''
+			Returns the cost of every config and whether they are in seconds. Before anything has been
+			measured the costs are the relative flop estimates.
+		'''
+		is_measured = ~np.isnan(self.measured)
+		if not is_measured.any():
+			return self.estimates, False
+		scale = np.median(self.measured[is_measured] / self.estimates[is_measured])
+		return np.where(is_measured, self.measured, self.estimates * scale), True
+
+
 import pdb
 class SearchOptions(object):
 	def __init__(
 					self, config, prim_aux_lr, aux_lr, use_EG= False, step_every=1,
 					use_factored_model=True, is_cuda=True, token_temp=1.0, warmstart_path=None,
-					pure_transform=False
+					pure_transform=False, weight_storage='dense', config_sampler='uniform'
 				):
+		assert weight_storage in WEIGHT_STORAGE_CHOICES, 'Invalid weight storage : {}'.format(weight_storage)
+		assert config_sampler in CONFIG_SAMPLER_CHOICES, 'Invalid config sampler : {}'.format(config_sampler)
 		self.config = config  # Store in case
 		self.weight_lr = prim_aux_lr
 		self.aux_lr = aux_lr
@@ -40,6 +186,12 @@ class SearchOptions(object):
 		self.step_every = step_every
 		self.step_counter = 0
 		self.pure_transform = pure_transform 
+		self.weight_storage = weight_storage
+		self.is_compact = weight_storage == 'compact'
+		self.config_sampler = config_sampler
+		# Timings are only recorded for the cost-aware sampler since measuring them needs device syncs
+		self.track_costs = config_sampler == 'cost-aware'
+		self.cost_params, self.step_time_budget = {}, None
 
 		num_stages = self.config.num_stages()
 		base_shape = [1 for _ in range(num_stages)]
@@ -50,24 +202,34 @@ class SearchOptions(object):
 			# Add the primary task to the output
 			shape = list(base_shape)
 			shape[stage_id] = len(ids_)
+			all_dims[stage_id] = shape[stage_id]
+			if self.is_compact:
+				shape = [len(ids_)]
 			st_weights = create_tensor(shape, init=int(use_EG), requires_grad=use_factored_model, is_cuda=is_cuda)
 			self.weights[stage_name] = st_weights
-			all_dims[stage_id] = shape[stage_id]
 			self.stage_order.append(stage_name)
-		self.weights['all'] = create_tensor(all_dims, init=int(use_EG), requires_grad=True, is_cuda=is_cuda)
-		self.stage_order.append('all')
+		self.all_dims = all_dims
 		self.valid_configurations = None
 		self.create_mask_for_illegal(all_dims, is_cuda)
+		self.weights['all'] = create_tensor(self.weights['mask'].shape, init=int(use_EG), requires_grad=True, is_cuda=is_cuda)
+		self.stage_order.append('all')
+		self.build_config_index()
+		# The table enumerates the config's valid space, so configs drawn from that space have table ids
+		self.table_from_space = True
 
 		self.prim_weight =  create_tensor((1,), init=int(use_EG), requires_grad=True, is_cuda=is_cuda)
 		self.aux_weight = create_tensor((1,), init=int(use_EG), requires_grad=True, is_cuda=is_cuda)
 
-		self.config_upstream_grad = create_tensor(all_dims,init=int(use_EG), requires_grad=False, is_cuda=is_cuda)
+		self.config_upstream_grad = create_tensor(self.weights['all'].shape, init=int(use_EG), requires_grad=False, is_cuda=is_cuda)
 		self.prim_upstream_grad = create_tensor((1,), init=int(use_EG), requires_grad=False, is_cuda=is_cuda)
 		self.aux_upstream_grad = create_tensor((1,), init=int(use_EG), requires_grad=False, is_cuda=is_cuda)
 
 		self.use_EG = use_EG
 		self.tau = token_temp
+		# Bumped every time the weights change so that cached distributions can be invalidated
+		self.weights_version = 0
+		self.dist_cache = None
+		self.setup_adaptive_sampling(None, None)
 		if warmstart_path and (os.path.exists(warmstart_path)):
 			self.load_state(warmstart_path)
 
@@ -77,7 +239,9 @@ class SearchOptions(object):
 		print('Saving SearchOpts state to : ', path)
 		save_dict = {
 			'weights': self.weights,
-			'valid_configs': self.valid_configurations
+			'valid_configs': self.config_table.tuples,
+			'pruned_configs': self.pruned_configurations,
+			'weight_storage': self.weight_storage
 		}
 		torch.save(
 			save_dict,
@@ -87,113 +251,425 @@ class SearchOptions(object):
 	def load_state(self, path):
 		print('Loading SearchOpts state from : ', path)
 		state_dict = torch.load(path)
-		self.weights = state_dict['weights']
+		self.valid_configurations = state_dict['valid_configs']
+		self.build_config_index()
+		# The checkpoint's configs need not cover the whole valid space
+		self.table_from_space = False
+		# Pruned configs keep their slot in the weights (masked out) but are no longer searched over
+		pruned = set(state_dict.get('pruned_configs', []))
+		self.valid_configurations = [config_ for config_ in self.valid_configurations if config_ not in pruned]
+		self.pruned_configurations = list(pruned)
+		# Older checkpoints do not record their storage and are always dense
+		saved_storage = state_dict.get('weight_storage', 'dense')
+		if saved_storage == self.weight_storage:
+			self.weights = state_dict['weights']
+		elif self.is_compact:
+			self.weights = self.dense_to_compact(state_dict['weights'])
+		else:
+			self.weights = self.compact_to_dense(state_dict['weights'])
 		for name, weight in self.weights.items():
 			# Todo [ldery] - could do some sort of thresholding here if we wanted to that 
 			# auxiliary tasks that have essentially low values previously will be set to zero
 			if weight.requires_grad and (weight.grad is not None):
 				with torch.no_grad():
 					weight.grad.zero_()
-	
-		self.valid_configurations = state_dict['valid_configs']
+		# The set of valid configs can differ from the one we were constructed with
+		self.config_upstream_grad = torch.zeros_like(self.weights['all'])
+		self.weights_version += 1
+
+	def build_config_index(self):
+		# The table is fixed from here on : pruning only removes configs from valid_configurations so table ids stay put
+		self.config_table = ConfigTable(self.config, self.valid_configurations, self.all_dims, self.weights['mask'].device)
+		self.pending_config_ids, self.pending_config_grads = [], []
+		self.pruned_configurations = []
+		self.below_threshold = np.zeros(len(self.config_table), dtype=np.int64)
+		self.cost_model = ConfigCostModel(self.config, self.config_table, **self.cost_params)
+		# Running average of the magnitude of each config's meta-gradient. Used as its expected utility
+		self.meta_grad_mag = np.full(len(self.config_table), np.nan)
+
+	def setup_cost_model(self, seq_len, hidden_size, num_layers, vocab_size, time_budget=None, mask_proba=0.15):
+		# Sizes for the flop estimates of configs that have not been timed yet
+		self.cost_params = {
+								'seq_len': seq_len, 'hidden_size': hidden_size, 'num_layers': num_layers,
+								'vocab_size': vocab_size, 'mask_proba': mask_proba
+						}
+		self.step_time_budget = time_budget
+		self.cost_model = ConfigCostModel(self.config, self.config_table, **self.cost_params)
+
+	def record_config_cost(self, config, seconds):
+		self.cost_model.update(self.config_table.id_of[config], seconds)
+
+	def weight_index(self, config):
+		# Index into weights['all'] (and anything shaped like it) for a given config tuple
+		if self.is_compact:
+			return self.config_table.id_of[config]
+		return config
+
+	def weight_index_tensor(self, config_idxs):
+		# Batched version of weight_index for a [num_configs, num_stages] index tensor
+		if self.is_compact:
+			return self.config_table.ids_from_tensor(config_idxs)
+		return tuple(config_idxs.unbind(dim=-1))
+
+	def flat_weight_index(self, config_ids):
+		# Index into weights['all'].view(-1) for a tensor of flat config ids
+		if self.is_compact:
+			return config_ids
+		return self.config_table.ravel_ids[config_ids]
+
+	def configs_to_tensor(self, configs):
+		# Build the index tensor on the host and copy it over without waiting on the device
+		config_idxs = torch.tensor(configs, dtype=torch.long).view(-1, self.config.num_stages())
+		device = self.weights['mask'].device
+		if device.type == 'cuda':
+			return config_idxs.pin_memory().to(device, non_blocking=True)
+		return config_idxs
+
+	def dense_to_compact(self, weights):
+		valid_idxs = tuple(torch.from_numpy(self.config_table.configs).T)
+		new_weights = {}
+		for name, weight in weights.items():
+			if name in ['all', 'mask']:
+				new_weight = weight.detach()[valid_idxs].clone()
+			else:
+				new_weight = weight.detach().view(-1).clone()
+			new_weights[name] = new_weight.requires_grad_(weight.requires_grad)
+		return new_weights
+
+	def compact_to_dense(self, weights):
+		valid_idxs = tuple(torch.from_numpy(self.config_table.configs).T)
+		new_weights = {}
+		for stage_id, name in enumerate(self.stage_order):
+			if name in ['all', 'mask']:
+				continue
+			shape = [1 for _ in self.all_dims]
+			shape[stage_id] = self.all_dims[stage_id]
+			new_weights[name] = weights[name].detach().view(*shape).clone()
+		for name, fill_value in [('all', 0.0), ('mask', float('-inf'))]:
+			weight = weights[name].detach()
+			new_weight = torch.full(self.all_dims, fill_value, dtype=weight.dtype, device=weight.device)
+			new_weight[valid_idxs] = weight
+			new_weights[name] = new_weight
+		for name, weight in weights.items():
+			new_weights[name].requires_grad_(weight.requires_grad)
+		return new_weights
 
 
 	def get_valid_configs(self):
 		return self.valid_configurations
 
-	def get_all_and_out_relative(self, aux_configs):
-		# gather all the likelihoods:
-		values = []
-		stage_name, _ = self.config.get_stage_w_name(3)
+	def prune_configs(self, threshold, patience=1):
+		'''
+			Removes the configs whose joint probability has been below threshold for patience calls in a row.
+			They are masked out of the weights and dropped from valid_configurations. At least one config is
+			always kept. Returns the list of configs that were pruned.
+		'''
+		probas = self.get_distributions()['valid_log_probas'].exp().cpu().numpy()
+		active_ids = self.config_table.ids(self.valid_configurations)
+		is_below = probas[active_ids] < threshold
+		self.below_threshold[active_ids] = np.where(is_below, self.below_threshold[active_ids] + 1, 0)
+		to_prune = active_ids[self.below_threshold[active_ids] >= patience]
+		if len(to_prune) == len(active_ids):
+			to_prune = to_prune[to_prune != active_ids[np.argmax(probas[active_ids])]]
+		if len(to_prune) == 0:
+			return []
+		with torch.no_grad():
+			prune_ids = torch.from_numpy(to_prune).to(self.weights['mask'].device)
+			self.weights['mask'].view(-1)[self.flat_weight_index(prune_ids)] = float('-inf')
+		pruned = [self.config_table.tuples[id_] for id_ in to_prune]
+		pruned_set = set(pruned)
+		self.valid_configurations = [config_ for config_ in self.valid_configurations if config_ not in pruned_set]
+		self.pruned_configurations.extend(pruned)
+		self.weights_version += 1
+		print('[STAT] Pruned {} configs. {} valid tasks remain'.format(len(pruned), len(self.valid_configurations)))
+		return pruned
+
+	def get_all_and_out_relative(self, aux_configs, importance_weights=None):
+		config_idxs = self.configs_to_tensor(aux_configs)
+		log_importance = None
+		if importance_weights is not None:
+			log_importance = [math.log(importance_weights[config_]) for config_ in aux_configs]
+			log_importance = torch.tensor(log_importance, device=self.weights['all'].device)
+		return ConfigProbas(aux_configs, self.get_all_and_out_relative_tensor(config_idxs, log_importance))
+
+	def get_all_and_out_relative_tensor(self, config_idxs, log_importance=None):
+		'''
+			config_idxs is a [num_configs, num_stages] LongTensor on the weights' device.
+			Returns the softmax over (all + output-stage) logits of those configs, computed on device.
+			log_importance optionally corrects for configs that were not sampled uniformly.
+		'''
+		out_stage = self.config.num_stages() - 1
+		stage_name, _ = self.config.get_stage_w_name(out_stage)
+		with torch.no_grad():
+			logits = self.weights['all'][self.weight_index_tensor(config_idxs)]
+			logits = logits + self.weights[stage_name].view(-1)[config_idxs[:, out_stage]]
+			if log_importance is not None:
+				logits = logits + log_importance
+			return F.softmax(logits, dim=-1)
+
+	def get_distributions(self):
+		'''
+			Returns every stage's distribution and the joint softmax over configs. These are computed on the
+			weights' device at most once per weight update (tracked by weights_version). The stage
+			distributions are small, so a host copy is also kept for the data pipeline which needs python floats.
+			The returned tensors are shared and should not be modified in place.
+		'''
+		if (self.dist_cache is not None) and (self.dist_cache['version'] == self.weights_version):
+			return self.dist_cache
+		num_stages = self.config.num_stages()
+		with torch.no_grad():
+			raw, prim_raw, aux_raw = self.get_weighttensor_wgrad(softmax=False)
+			joint = F.softmax(raw.view(-1), dim=-1).view(*raw.shape)
+			prim_aux = F.softmax(torch.cat((prim_raw, aux_raw)), dim=-1)
+			stage_raw = [self.weights[self.stage_order[stage_id]].view(-1) for stage_id in range(num_stages)]
+			stage_probas = [F.softmax(weight, dim=-1) for weight in stage_raw]
+			# A single device to host copy for all the stages
+			stage_sizes = [weight.numel() for weight in stage_raw]
+			stage_cpu = torch.cat(stage_raw + stage_probas).cpu()
+			stage_cpu = torch.split(stage_cpu, stage_sizes + stage_sizes)
+		stage_named = []
+		for stage_id in range(num_stages):
+			_, stage_dict = self.config.get_stage_w_name(stage_id)
+			probas = stage_cpu[num_stages + stage_id].tolist()
+			stage_named.append({v: probas[k] for k, v in stage_dict.items()})
 		with torch.no_grad():
-			for conf_ in aux_configs:
-				this_logit = (self.weights['all'][conf_[0], conf_[1], conf_[2], conf_[3]]).item()
-				this_logit += (self.weights[stage_name][0, 0, 0, conf_[3]]).item()
-				values.append(this_logit)
-			values = F.softmax(torch.tensor(values), dim=-1)
-			values = values.numpy().tolist()
-			probas = {}
-			for k, v in zip(aux_configs, values):
-				probas[k] = v
-		return probas
+			# Log-probabilities of the valid configs in flat id order
+			valid_ids = torch.arange(len(self.config_table), device=raw.device)
+			valid_log_probas = F.log_softmax(raw.view(-1)[self.flat_weight_index(valid_ids)], dim=-1)
+		self.dist_cache = {
+			'version': self.weights_version,
+			'raw': raw,
+			'joint': joint,
+			'prim_raw': prim_raw.detach(),
+			'aux_raw': aux_raw.detach(),
+			'prim': prim_aux[0],
+			'aux': prim_aux[1],
+			'stage_probas': stage_probas,
+			'stage_raw_cpu': stage_cpu[:num_stages],
+			'stage_probas_cpu': stage_cpu[num_stages:],
+			'stage_named': stage_named,
+			'valid_log_probas': valid_log_probas,
+			'bert_relative': {},
+		}
+		return self.dist_cache
 
 	def get_relative_probas(self, stage_id, stage_members, w_names=False):
-		stage_name, stage_dict = self.config.get_stage_w_name(stage_id)
+		dists = self.get_distributions()
+		if w_names:
+			return dists['stage_named'][stage_id]
 		if stage_members is None:
-			stage_members = list(stage_dict.keys())
-		with torch.no_grad():
-			this_weights = (self.weights[stage_name]).squeeze()
-			if this_weights.numel() == 1:
-				this_weights = this_weights.unsqueeze(0)
-			this_weights = this_weights.cpu().numpy()
-			values = np.array([this_weights[id_] for id_ in stage_members])
-			probas = F.softmax(torch.tensor(list(values)), dim=-1)
-		if not w_names:
-			return probas
-		else:
-			probas = probas.numpy().tolist()
-			proba_dict = {}
-			for k, v in stage_dict.items():
-				proba_dict[v] = probas[k]
-			return proba_dict
-	
+			return dists['stage_probas_cpu'][stage_id]
+		# Renormalize over the requested members. This is a tiny host-side op on the cached logits
+		stage_members = torch.as_tensor(np.asarray(stage_members), dtype=torch.long)
+		return F.softmax(dists['stage_raw_cpu'][stage_id][stage_members], dim=-1)
+
 	def get_bert_relative(self, stage_id, tform_name, tform_id):
-		stage_name, stage_dict = self.config.get_stage_w_name(stage_id)
-		with torch.no_grad():
-			if self.pure_transform:
-				bias_ = {'None': float('-inf'), 'Replace': float('-inf'), 'Mask':float('-inf')}
-				bias_[tform_name] = self.tau
-			else:
-				this_weights = (self.weights[stage_name]).squeeze().cpu().numpy()
-				# We want to add ['None'=0.1, 'Replace'=0.1, 'Mask'=0.8] as a bias
-				bias_ = {'None': 0, 'Replace': 0, 'Mask': 2.0794 * self.tau}
-				bias_[tform_name] = bias_[tform_name] + this_weights[tform_id]
-			values = np.array(list(bias_.values())) / self.tau
-			probas = F.softmax(torch.tensor(list(values)), dim=-1).numpy().tolist()
-			proba_dict = {}
-			for k, v in zip(bias_.keys(), probas):
-				proba_dict[k] = v
+		dists = self.get_distributions()
+		key_ = (stage_id, tform_name, tform_id)
+		if key_ in dists['bert_relative']:
+			return dists['bert_relative'][key_]
+		if self.pure_transform:
+			bias_ = {'None': float('-inf'), 'Replace': float('-inf'), 'Mask':float('-inf')}
+			bias_[tform_name] = self.tau
+		else:
+			this_weight = dists['stage_raw_cpu'][stage_id][tform_id].item()
+			# We want to add ['None'=0.1, 'Replace'=0.1, 'Mask'=0.8] as a bias
+			bias_ = {'None': 0, 'Replace': 0, 'Mask': 2.0794 * self.tau}
+			bias_[tform_name] = bias_[tform_name] + this_weight
+		values = np.array(list(bias_.values())) / self.tau
+		probas = F.softmax(torch.tensor(list(values)), dim=-1).numpy().tolist()
+		proba_dict = {}
+		for k, v in zip(bias_.keys(), probas):
+			proba_dict[k] = v
+		dists['bert_relative'][key_] = proba_dict
 		return proba_dict
 
+	def get_config_weights(self, configs, softmax=True):
+		# Joint weights of the given configs, looked up from the cache and copied to host lazily
+		dists = self.get_distributions()
+		weight_tensor = dists['joint'] if softmax else dists['raw']
+		config_idxs = self.configs_to_tensor(configs)
+		return ConfigProbas(configs, weight_tensor[self.weight_index_tensor(config_idxs)])
+
 	def get_config_human_readable(self, config):
-		name_ = ''
-		for stage_id in range(len(config)):
-			stage_name, ids_ = self.config.get_stage_w_name(stage_id)
-			stage_ = "{}={}".format(stage_name, ids_[config[stage_id]])
-			name_ = "{}|{}".format(name_, stage_) if len(name_) else stage_
-		return name_
+		if config in self.config_table.id_of:
+			return self.config_table.names[self.config_table.id_of[config]]
+		return config_to_str(config, self.config)
 	
-	def sample_configurations(self, num_samples):
-		if num_samples >= len(self.valid_configurations):
-			return self.valid_configurations
-		idxs = np.random.choice(len(self.valid_configurations), size=num_samples, replace=False)
-		return [self.valid_configurations[idx_] for idx_ in idxs]
+	def setup_adaptive_sampling(self, min_samples, max_samples, tol=0.25, budget=None, decay=0.9):
+		'''
+			Enables choosing the number of configs per step from the spread of the cosine meta-gradients.
+			Passing max_samples=None disables it. budget is the average compute per step, counted in configs of
+			average cost under the cost model : unused budget from cheap steps is banked and can be spent on later
+			steps, up to max_samples.
+		'''
+		self.adaptive_samples = max_samples is not None
+		if self.adaptive_samples:
+			# At least two configs per step are needed to keep estimating the variance
+			assert 2 <= min_samples <= max_samples, 'Need 2 <= min_samples <= max_samples'
+			assert tol > 0, 'The tolerance must be positive'
+		self.min_samples, self.max_samples = min_samples, max_samples
+		self.samples_tol, self.samples_budget, self.samples_decay = tol, budget, decay
+		self.samples_credit = 0.0
+		self.meta_grad_var, self.meta_grad_sq = None, None
+		self.step_meta_grads = []
+
+	def record_meta_grad_stats(self):
+		# Fold the meta-gradients seen since the last call into running estimates of their variance and second moment
+		grads = self.step_meta_grads
+		self.step_meta_grads = []
+		if len(grads) < 2:
+			return
+		grads = np.array(grads)
+		var_, sq_ = grads.var(ddof=1), np.mean(grads ** 2)
+		if self.meta_grad_var is None:
+			self.meta_grad_var, self.meta_grad_sq = var_, sq_
+		else:
+			self.meta_grad_var = self.samples_decay * self.meta_grad_var + (1 - self.samples_decay) * var_
+			self.meta_grad_sq = self.samples_decay * self.meta_grad_sq + (1 - self.samples_decay) * sq_
+
+	def num_config_samples(self, num_samples):
+		'''
+			Returns how many configs to sample this step. num_samples is returned as is unless adaptive sampling is on.
+			The count is the smallest n for which the standard error of the mean meta-gradient is within tol of its
+			root-mean-square: n = var / (tol^2 * E[g^2]). When the sampled configs agree, few are needed.
+		'''
+		if not self.adaptive_samples:
+			return num_samples
+		self.record_meta_grad_stats()
+		if self.meta_grad_var is None:
+			# Nothing observed yet : start with as many configs as allowed
+			num_samples = self.max_samples
+		else:
+			needed = self.meta_grad_var / ((self.samples_tol ** 2) * self.meta_grad_sq + 1e-12)
+			num_samples = int(math.ceil(needed))
+		num_samples = max(self.min_samples, min(self.max_samples, num_samples))
+		if self.samples_budget is not None:
+			# The sampled configs are charged for in sample_configurations once we know what they cost
+			self.samples_credit = min(self.samples_credit + self.samples_budget, self.max_samples)
+			num_samples = max(self.min_samples, min(num_samples, int(self.samples_credit)))
+		return num_samples
+
+	def charge_samples_budget(self, configs):
+		# Each config costs its cost-model estimate relative to the average valid config, so cheap configs use less budget
+		costs, _ = self.cost_model.costs()
+		valid_ids = self.config_table.ids(self.valid_configurations)
+		ids = self.config_table.ids(configs)
+		self.samples_credit -= costs[ids].sum() / (costs[valid_ids].mean() + 1e-12)
+
+	def sample_configurations(self, num_samples, return_importance=False):
+		'''
+			Returns a list of configs. With return_importance, also returns a dict of per-config importance
+			weights (None when the configs were sampled uniformly or when every config is returned).
+		'''
+		importance_weights = None
+		if self.config_sampler == 'cost-aware':
+			# The time budget can cut the sample short even when every config is requested
+			configs, importance_weights = self.sample_cost_aware(num_samples)
+		elif num_samples >= len(self.valid_configurations):
+			configs = self.valid_configurations
+		elif self.config_sampler == 'gumbel-topk':
+			configs, importance_weights = self.sample_gumbel_topk(num_samples)
+		elif self.table_from_space and (len(self.pruned_configurations) == 0):
+			# Draw ranks and unrank them instead of indexing a list of every valid config
+			configs = self.config.get_valid_space().sample(num_samples)
+		else:
+			idxs = np.random.choice(len(self.valid_configurations), size=num_samples, replace=False)
+			configs = [self.valid_configurations[idx_] for idx_ in idxs]
+		if self.adaptive_samples and (self.samples_budget is not None):
+			self.charge_samples_budget(configs)
+		if return_importance:
+			return configs, importance_weights
+		return configs
+
+	def sample_gumbel_topk(self, num_samples):
+		'''
+			Samples num_samples configs without replacement in proportion to the joint weights by taking the
+			top-k of the Gumbel-perturbed log-probabilities on device. The (k+1)-th perturbed value gives the
+			inclusion probability q_i = 1 - exp(-p_i / exp(kappa)) of each sampled config (priority sampling),
+			and the importance weight (k / n) / q_i makes each config's expected contribution match the
+			uniform sampler.
+		'''
+		dists = self.get_distributions()
+		num_configs = len(self.valid_configurations)
+		with torch.no_grad():
+			log_probas = dists['valid_log_probas']
+			uniform = torch.rand_like(log_probas).clamp_(min=1e-10)
+			perturbed = log_probas - torch.log(-torch.log(uniform))
+			top_vals, top_ids = torch.topk(perturbed, num_samples + 1)
+			kappa = top_vals[-1]
+			chosen = top_ids[:num_samples]
+			incl_probas = -torch.expm1(-torch.exp(log_probas[chosen] - kappa))
+			importance = (num_samples / num_configs) / incl_probas.clamp(min=1e-10)
+			# One host copy for both the ids and their weights
+			chosen, importance = torch.stack((chosen.to(importance.dtype), importance)).tolist()
+		configs = [self.config_table.tuples[int(id_)] for id_ in chosen]
+		return configs, dict(zip(configs, importance))
+
+	def sample_cost_aware(self, num_samples):
+		'''
+			Draws configs without replacement in proportion to utility / cost, where the utility of a config is its joint
+			weight times the running magnitude of its meta-gradient (the mean magnitude for configs not seen yet).
+			The sampled order is cut at num_samples or where the summed cost would exceed the step time budget,
+			whichever comes first, and at least one config is always kept. Importance weights are computed as in
+			sample_gumbel_topk with the first dropped config setting the threshold.
+		'''
+		num_configs = len(self.valid_configurations)
+		log_probas = self.get_distributions()['valid_log_probas'].cpu().numpy().astype(np.float64)
+		costs, in_seconds = self.cost_model.costs()
+		seen = ~np.isnan(self.meta_grad_mag)
+		utility = np.where(seen, self.meta_grad_mag, self.meta_grad_mag[seen].mean() if seen.any() else 1.0)
+		log_scores = log_probas + np.log(utility + 1e-10) - np.log(costs)
+
+		perturbed = log_scores - np.log(-np.log(np.random.uniform(1e-10, 1.0, size=len(log_scores))))
+		order = np.argsort(-perturbed)
+		num_chosen = min(num_samples, num_configs)
+		if in_seconds and (self.step_time_budget is not None):
+			within_budget = np.cumsum(costs[order[:num_chosen]]) <= self.step_time_budget
+			num_chosen = max(1, int(within_budget.sum()))
+		chosen = order[:num_chosen]
+		if num_chosen < num_configs:
+			kappa = perturbed[order[num_chosen]]
+			incl_probas = -np.expm1(-np.exp(log_scores[chosen] - kappa))
+		else:
+			incl_probas = np.ones(num_chosen)
+		importance = (num_chosen / num_configs) / np.maximum(incl_probas, 1e-10)
+		configs = [self.config_table.tuples[id_] for id_ in chosen]
+		return configs, dict(zip(configs, importance.tolist()))
 
 	def create_mask_for_illegal(self, all_dims, is_cuda):
-		assert len(all_dims) == 4, 'This assumes that there are only 4 stages. If not, please consider re-writing this function'
-		self.valid_configurations = []
-		# This is quite inefficient but since we only do it once, I think it's ok.
-		# Will try to come up with a more polished version if it raises issues
-		# This also assumes that there are only 4 stages.
-		self.weights['mask'] = create_tensor(all_dims, init=0.0, requires_grad=False, is_cuda=is_cuda)
 		self.stage_order.append('mask')
-		neg_inf = float('-inf')
-		for i in range(all_dims[0]):
-			for j in range(all_dims[1]):
-				for k in range(all_dims[2]):
-					for l in range(all_dims[3]):
-						if (self.config.is_illegal((i, j, k, l))):
-							self.weights['mask'][i, j, k, l] = neg_inf
-						else:
-							self.valid_configurations.append((i, j, k, l))
+		if self.is_compact:
+			# Illegal configs are simply not stored. The valid ones are enumerated (in lexicographic order) from the
+			# valid space, which skips the full stage product, but every valid config is still listed : the
+			# config table, the 'all' weights and the heads all hold one entry per valid config
+			self.valid_configurations = list(self.config.get_valid_space())
+			self.weights['mask'] = create_tensor((len(self.valid_configurations),), init=0.0, requires_grad=False, is_cuda=is_cuda)
+			return
+		# The illegal mask is built by broadcasting the per-stage-pair illegal tables from the config
+		illegal = torch.from_numpy(self.config.get_illegal_mask())
+		assert list(illegal.shape) == list(all_dims), 'Illegal mask does not match the weight dimensions'
+		# nonzero enumerates in lexicographic order so this matches the order of the stage product
+		self.valid_configurations = [tuple(x) for x in torch.nonzero(~illegal).tolist()]
+		self.weights['mask'] = create_tensor(all_dims, init=0.0, requires_grad=False, is_cuda=is_cuda)
+		self.weights['mask'].masked_fill_(illegal.to(self.weights['mask'].device), float('-inf'))
 
 
 	def get_weighttensor_nograd(self, softmax=True):
-		with torch.no_grad():
-			return self.get_weighttensor_wgrad(softmax=softmax)
+		dists = self.get_distributions()
+		if softmax:
+			return dists['joint'], dists['prim'], dists['aux']
+		return dists['raw'], dists['prim_raw'], dists['aux_raw']
 
 	def get_weighttensor_wgrad(self, softmax=True):
-		aux_config_tensor = sum([self.weights[name] for name in self.stage_order])
+		if self.is_compact:
+			# Gather the factored stage weights for every valid config and add the per-config logits
+			aux_config_tensor = self.weights['all'] + self.weights['mask']
+			for stage_id in range(self.config.num_stages()):
+				stage_weights = self.weights[self.stage_order[stage_id]]
+				aux_config_tensor = aux_config_tensor + stage_weights[self.config_table.tensor[:, stage_id]]
+		else:
+			aux_config_tensor = sum([self.weights[name] for name in self.stage_order])
 		full_ = torch.cat((self.prim_weight, self.aux_weight))
 		if softmax:
 			# Compute Normalization over all entries
@@ -208,27 +684,61 @@ class SearchOptions(object):
 	# Not the cleanest way to do this but it's ok for now
 	def update_grad(self, config, grad):
 		if isinstance(config, tuple):
-			self.config_upstream_grad[config[0], config[1], config[2], config[3]].add_(grad)
+			# Buffered and written with a single index_add_ in flush_config_grads
+			self.pending_config_ids.append(self.config_table.id_of[config])
+			self.pending_config_grads.append(float(grad))
+			if self.adaptive_samples:
+				self.step_meta_grads.append(float(grad))
+			if self.track_costs:
+				config_id, decay = self.pending_config_ids[-1], self.cost_model.decay
+				mag_, old_ = abs(float(grad)), self.meta_grad_mag[config_id]
+				self.meta_grad_mag[config_id] = mag_ if np.isnan(old_) else decay * old_ + (1 - decay) * mag_
 		elif config == 'auxiliary':
 			self.aux_upstream_grad.add_(grad)
 		else:
 			self.prim_upstream_grad.add_(grad)
+
+	def flush_config_grads(self):
+		if len(self.pending_config_ids) == 0:
+			return
+		device = self.config_upstream_grad.device
+		config_ids = torch.tensor(self.pending_config_ids, dtype=torch.long, device=device)
+		grads = torch.tensor(self.pending_config_grads, dtype=self.config_upstream_grad.dtype, device=device)
+		self.config_upstream_grad.view(-1).index_add_(0, self.flat_weight_index(config_ids), grads)
+		self.pending_config_ids, self.pending_config_grads = [], []
 	
 	def clear_grads(self):
 		self.config_upstream_grad.zero_()
 		self.prim_upstream_grad.zero_()
 		self.aux_upstream_grad.zero_()
+		self.pending_config_ids, self.pending_config_grads = [], []
 
-	def set_weightensor_grads(self, upstream_grad_tensor, prim_upstream_grad, aux_upstream_grad):
-		weight_tensor, prim_weight, aux_weight = self.get_weighttensor_wgrad(softmax=False)
-		proxy_loss = (weight_tensor * upstream_grad_tensor).sum()
-		proxy_loss.backward()
+	def accumulate_grad(self, weight, grad):
+		if weight.grad is None:
+			weight.grad = grad.clone()
+		else:
+			weight.grad.add_(grad)
 
-		proxy_loss = (prim_weight * prim_upstream_grad).sum()
-		proxy_loss.backward()
-		
-		proxy_loss = (aux_weight * aux_upstream_grad).sum()
-		proxy_loss.backward()
+	def set_weightensor_grads(self, upstream_grad_tensor, prim_upstream_grad, aux_upstream_grad):
+		# The config logits are the sum of 'all', the mask and the per-stage weights, and the proxy loss is
+		# sum(logits * upstream). Its gradient is the upstream grad for 'all' and the upstream grad summed
+		# over all other stages for each stage weight, so we write these directly instead of calling backward.
+		num_stages = self.config.num_stages()
+		with torch.no_grad():
+			self.accumulate_grad(self.weights['all'], upstream_grad_tensor)
+			for stage_id in range(num_stages):
+				weight = self.weights[self.stage_order[stage_id]]
+				if not weight.requires_grad:
+					continue
+				if self.is_compact:
+					stage_grad = torch.zeros_like(weight)
+					stage_grad.index_add_(0, self.config_table.tensor[:, stage_id], upstream_grad_tensor)
+				else:
+					other_dims = [dim_ for dim_ in range(num_stages) if dim_ != stage_id]
+					stage_grad = upstream_grad_tensor.sum(dim=other_dims, keepdim=True)
+				self.accumulate_grad(weight, stage_grad)
+			self.accumulate_grad(self.prim_weight, prim_upstream_grad)
+			self.accumulate_grad(self.aux_weight, aux_upstream_grad)
 
 
 	def get_exp_update(self, weight, lr, is_output=False, factor=None):
@@ -245,6 +755,7 @@ class SearchOptions(object):
 
 	def update_weighttensor(self):
 		self.step_counter += 1
+		self.flush_config_grads()
 		self.set_weightensor_grads(self.config_upstream_grad, self.prim_upstream_grad, self.aux_upstream_grad)
 		if (self.step_counter % self.step_every) == 0:
 			output_norm, all_norm = None, None
@@ -260,6 +771,7 @@ class SearchOptions(object):
 				assert self.prim_weight.grad is not None, 'Prim Weight should have gradients'
 				self.update_weight(self.prim_weight, self.weight_lr)
 				self.update_weight(self.aux_weight, self.weight_lr)
+			self.weights_version += 1
 
 		self.clear_grads()
 
@@ -301,5 +813,26 @@ def run_tests():
 		msg = 'Failed.'
 	print("run_tests : {}".format(msg))
 
+def test_sample_after_warmstart():
+	try:
+		full_config = Config('full')
+		searchOps = SearchOptions(full_config, 1.0, 1.0, is_cuda=False)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			path = os.path.join(tmp_dir, 'searchOpts.pt')
+			searchOps.save_state(path)
+			state_dict = torch.load(path)
+			state_dict['valid_configs'] = state_dict['valid_configs'][::2]
+			torch.save(state_dict, path)
+			warm_ops = SearchOptions(full_config, 1.0, 1.0, is_cuda=False, warmstart_path=path)
+		assert len(warm_ops.valid_configurations) == len(state_dict['valid_configs']), 'Warmstart did not restore the valid configs'
+		for _ in range(20):
+			configs = warm_ops.sample_configurations(5)
+			assert all([config_ in warm_ops.config_table.id_of for config_ in configs]), 'Sampled a config outside of the table'
+		msg = 'Passed.'
+	except:
+		msg = 'Failed.'
+	print("test_sample_after_warmstart : {}".format(msg))
+
 if __name__ == '__main__':
 	run_tests()
+	test_sample_after_warmstart()
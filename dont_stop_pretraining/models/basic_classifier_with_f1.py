@@ -234,6 +234,13 @@ class BasicSequenceTagger(BasicClassifierWithF1):
 			mask = None
 			embedded_text = embedded_text[1][-1]
 
+		# Only the positions with a label (label >= 0) go through the head. The others would get a zero loss anyway
+		active = None
+		if label is not None:
+			label = label.view(-1)
+			active = label >= 0
+			embedded_text = embedded_text.reshape(-1, embedded_text.shape[-1])[active]
+
 		if self._dropout:
 			embedded_text = self._dropout(embedded_text)
 
@@ -243,40 +250,42 @@ class BasicSequenceTagger(BasicClassifierWithF1):
 
 		output_dict = {}
 		if self.is_classification_task:
+			# These are over the active positions only when labels are given
 			probs = torch.nn.functional.softmax(logits, dim=-1).view(-1, logits.shape[-1])
 			output_dict = {"logits": logits, "probs": probs}
-			label = label.long()
 
 		if label is not None:
-			# TODO[LDERY] need to check if we consider the padding appropriately here
+			active_label = label[active]
 			if not self.is_classification_task:
-				logits, label = logits.view(-1), label.view(-1)
-				label_mask = (label >= 0).float()
-				label = label * label_mask
-				logits = logits * label_mask
+				logits = logits.view(-1)
 			else:
-				logits, label = logits.view(-1, logits.shape[-1]), label.view(-1)
-			loss = self._loss(logits, label)
+				logits, active_label = logits.view(-1, logits.shape[-1]), active_label.long()
+			active_loss = self._loss(logits, active_label)
 			if not self.is_classification_task:
-				scale_mask = (loss > self.max_loss_scale)*1.0
+				# Losses above max_loss_scale are scaled down to it. The factor carries no gradient
 				with torch.no_grad():
-					inv_ = 1.0 / ((scale_mask * loss) + (1.0 - scale_mask))
-					scale = (scale_mask * self.max_loss_scale) + (1.0 - scale_mask)
-					factor = (inv_ * scale).detach()
-				loss = loss * factor
+					factor = (self.max_loss_scale / active_loss).clamp(max=1.0)
+				active_loss = active_loss * factor
 			# Todo - ldery - need to bound
+			loss = torch.zeros(label.shape, dtype=active_loss.dtype, device=active_loss.device)
+			loss = loss.masked_scatter(active, active_loss)
 			output_dict["loss_full"] = loss
 			if not self.is_classification_task:
-				output_dict["loss"] = loss.sum() / (label_mask.float().sum())
+				output_dict["loss"] = loss.sum() / (active.float().sum())
 			else:
 				output_dict["loss"] = loss.mean()
 			if self.is_classification_task:
 # 				for i in range(self._num_labels):
 # 					metric = self._label_f1_metrics[self.vocab.get_token_from_index(index=i, namespace="labels")]
 # 					metric(probs, label)
-				self._accuracy(logits, label)
+				# Accuracy has always been over every position, with unlabelled ones counted as wrong. The few class
+				# scores are scattered back so the metric sees the same positions as before
+				with torch.no_grad():
+					logits_full = logits.new_zeros((label.shape[0], logits.shape[-1]))
+					logits_full[active] = logits
+				self._accuracy(logits_full, label.long())
 			else:
-				self._mae(logits[label >= 0].view(-1), label[label >= 0].view(-1))
+				self._mae(logits, active_label)
 		return output_dict
 	
 	def get_metrics(self, reset: bool = False) -> Dict[str, float]:
@@ -299,6 +308,14 @@ def batch_cos_sim(a, b):
 	return a_norm.matmul(b_norm.T)
 
 
+def paired_cos_sim(a, b):
+	# Row-wise batch_cos_sim : only the similarity of a[i] with b[i]
+	with torch.no_grad():
+		norm_a = a.norm(dim=-1) + EPS
+		norm_b = b.norm(dim=-1) + EPS
+	return (a * b).sum(dim=-1) / (norm_a * norm_b)
+
+
 @Model.register("basic_sentence_classifier_with_f1")
 class BasicSentenceClassifier(BasicClassifierWithF1):
 	def __init__(
@@ -342,27 +359,26 @@ class BasicSentenceClassifier(BasicClassifierWithF1):
 			pooled_text = self._dropout(pooled_text)
 		pooled_text = self.sent_feedforward(pooled_text)
 		pooled_text = self.sent_layernorm(pooled_text)
+		tok_tformed = embedded_text[1][-1]
 		if self._dropout:
-			tok_tformed = self._dropout(embedded_text[1][-1])
+			tok_tformed = self._dropout(tok_tformed)
 		tok_tformed = self.tok_feedforward(tok_tformed)
 		tok_tformed = self.tok_layernorm(tok_tformed)
 
-		tok_tformed = tok_tformed * (label > 0).float().unsqueeze(-1)
-		mask = torch.zeros_like(tok_tformed).masked_fill((label < 0).unsqueeze(-1), LARGE_NEG)
-		tok_tformed = torch.max(tok_tformed + mask, dim=1)[0]  # We are doing max-pooling here
+		# We are doing max-pooling here. Positions with label 0 count as zero vectors and positions with a negative
+		# label are left out. The fill values are [B, L] and only broadcast over the hidden dimension
+		fill = (label < 0).float() * LARGE_NEG
+		tok_tformed = torch.where((label > 0).unsqueeze(-1), tok_tformed, fill.unsqueeze(-1)).max(dim=1)[0]
 
 		n_batches = pooled_text.shape[0]
 		assert n_batches % 2 == 0, 'There has to be an even number of inputs here'
 
-		logits = batch_cos_sim(tok_tformed, pooled_text).squeeze()
-
-		updated_labels = list(range(n_batches))
-		updated_labels = torch.tensor(updated_labels[(n_batches // 2):] + updated_labels[:(n_batches // 2)]).view(-1, 1)
-		new_labels = updated_labels.to(label.device)
-
+		# Example i is paired with example i + n_batches / 2 (mod n_batches)
+		paired_text = torch.cat((pooled_text[(n_batches // 2):], pooled_text[:(n_batches // 2)]), dim=0)
+		logits = paired_cos_sim(tok_tformed, paired_text)
 
 		label_mask = 1.0 - ((label > 0).float().sum(dim=-1) == 0).float()
-		logits = label_mask * torch.gather(logits, 1, new_labels).squeeze()
+		logits = label_mask * logits
 		label = torch.ones(len(logits), device=label_mask.device) * label_mask
 
 		output_dict = {}
@@ -62,6 +62,9 @@ def add_hyperparam_options(parser):
 	parser.add_argument('-do-retrain', action='store_true')
 	parser.add_argument('-pure-transform', action='store_true')
 	parser.add_argument('-dev_head_val_base_bsz', type=int, default=36)
+	# Let each run pick its number of configs per step instead of sweeping nconf_samp
+	parser.add_argument('-adaptive-config-samples', action='store_true')
+	parser.add_argument('-max-config-samples', type=int, default=6)
 
 
 def get_task_info(args):
@@ -103,7 +106,10 @@ def get_base_runstring(args, gpuid, config, task_info):
 	logdir = "{}/MassLaunch/{}/{}/{}".format(args.logdir, args.exp_name, args.task, hyper_id)
 	os.makedirs(logdir, exist_ok=True)
 	this_output_dir = "{}/{}".format(args.output_dir, args.exp_name)
-	pure_transform_str = '-pure-transform' if args.pure_transform else ''
+	extra_flags_str = '-pure-transform' if args.pure_transform else ''
+	nconf_samp = config['nconf_samp'] if 'nconf_samp' in config else args.max_config_samples
+	if args.adaptive_config_samples:
+		extra_flags_str = '{} -adaptive-config-samples'.format(extra_flags_str)
 
 	run_commands, outdirs = [], []
 	for seed in range(args.num_seeds):
@@ -114,7 +120,7 @@ def get_base_runstring(args, gpuid, config, task_info):
 		run_command = None
 		if not has_been_run(outputdir):
 			warmup_frac = args.warmup_frac if 'wfrac' not in task_info else task_info['wfrac']
-			run_command = "CUDA_VISIBLE_DEVICES={} python -u -m scripts.autoaux --prim-task-id {} --train_data_file {} --dev_data_file {} --test_data_file {} --output_dir {} --model_type roberta-base --model_name_or_path roberta-base  --tokenizer_name roberta-base --per_gpu_train_batch_size {}  --gradient_accumulation_steps {} --do_train --learning_rate {} --block_size 512 --logging_steps 10000 --classf_lr {} --classf_patience {} --num_train_epochs {} --classifier_dropout {} --overwrite_output_dir --classf_iter_batchsz  {} --classf_ft_lr 1e-6 --classf_max_seq_len 512 --seed {}  --classf_dev_wd {} --classf_dev_lr {} -searchspace-config {} -task-data {} -in-domain-data {} -num-config-samples {} --dev_batch_sz {} --eval_every 30 -prim-aux-lr {} -auxiliaries-lr {} --classf_warmup_frac {} --classf_wd {} --base_wd {} --dev_fit_iters {} -step-meta-every {} -token_temp {} -use-factored-model --classf-metric {} {} --dev_head_val_base_bsz {} &> {}".format(gpuid, args.task, task_info['trainfile'], task_info['devfile'], task_info['testfile'], outputdir, pergpubsz, args.grad_accum_steps, args.lr, config['classflr'], args.patience, args.iters, args.classfdp, primiterbsz, seed, args.dev_wd, args.devlr, args.base_spconfig, task_info['taskdata'], task_info['domaindata'], config['nconf_samp'], args.devbsz, config['soptlr'], config['auxlr'], warmup_frac, args.classf_wd, args.base_wd, args.dev_ft_iters, args.step_meta_every, args.tokentform_temp, task_info['metric'], pure_transform_str, args.dev_head_val_base_bsz, logfile)
+			run_command = "CUDA_VISIBLE_DEVICES={} python -u -m scripts.autoaux --prim-task-id {} --train_data_file {} --dev_data_file {} --test_data_file {} --output_dir {} --model_type roberta-base --model_name_or_path roberta-base  --tokenizer_name roberta-base --per_gpu_train_batch_size {}  --gradient_accumulation_steps {} --do_train --learning_rate {} --block_size 512 --logging_steps 10000 --classf_lr {} --classf_patience {} --num_train_epochs {} --classifier_dropout {} --overwrite_output_dir --classf_iter_batchsz  {} --classf_ft_lr 1e-6 --classf_max_seq_len 512 --seed {}  --classf_dev_wd {} --classf_dev_lr {} -searchspace-config {} -task-data {} -in-domain-data {} -num-config-samples {} --dev_batch_sz {} --eval_every 30 -prim-aux-lr {} -auxiliaries-lr {} --classf_warmup_frac {} --classf_wd {} --base_wd {} --dev_fit_iters {} -step-meta-every {} -token_temp {} -use-factored-model --classf-metric {} {} --dev_head_val_base_bsz {} &> {}".format(gpuid, args.task, task_info['trainfile'], task_info['devfile'], task_info['testfile'], outputdir, pergpubsz, args.grad_accum_steps, args.lr, config['classflr'], args.patience, args.iters, args.classfdp, primiterbsz, seed, args.dev_wd, args.devlr, args.base_spconfig, task_info['taskdata'], task_info['domaindata'], nconf_samp, args.devbsz, config['soptlr'], config['auxlr'], warmup_frac, args.classf_wd, args.base_wd, args.dev_ft_iters, args.step_meta_every, args.tokentform_temp, task_info['metric'], extra_flags_str, args.dev_head_val_base_bsz, logfile)
 
 		outputdir_retrain = None
 		if args.do_retrain:
@@ -124,7 +130,7 @@ def get_base_runstring(args, gpuid, config, task_info):
 			os.makedirs(outputdir_retrain, exist_ok=True)
 			if not has_been_run(outputdir_retrain):
 				warmup_frac = args.warmup_frac if 'wfrac' not in task_info else task_info['wfrac']
-				retrain_run_command = "CUDA_VISIBLE_DEVICES={} python -u -m scripts.autoaux --prim-task-id {} --train_data_file {} --dev_data_file {} --test_data_file {} --output_dir {} --model_type roberta-base --model_name_or_path roberta-base  --tokenizer_name roberta-base --per_gpu_train_batch_size {}  --gradient_accumulation_steps {} --do_train --learning_rate {} --block_size 512 --logging_steps 10000 --classf_lr {} --classf_patience {} --num_train_epochs {} --classifier_dropout {} --overwrite_output_dir --classf_iter_batchsz  {} --classf_ft_lr 1e-6 --classf_max_seq_len 512 --seed {}  --classf_dev_wd {} --classf_dev_lr {} -searchspace-config {} -task-data {} -in-domain-data {} -num-config-samples {} --dev_batch_sz {} --eval_every 30 -prim-aux-lr {} -auxiliaries-lr {} --classf_warmup_frac {} --classf_wd {} --base_wd {} --dev_fit_iters {} -step-meta-every {} -token_temp {} -use-factored-model --classf-metric {} -warmstart-path {} {} &> {}".format(gpuid, args.task, task_info['trainfile'], task_info['devfile'], task_info['testfile'], outputdir_retrain, pergpubsz, args.grad_accum_steps, args.lr, config['classflr'], args.patience, args.iters, args.classfdp, primiterbsz, seed, args.dev_wd, args.devlr, args.base_spconfig, task_info['taskdata'], task_info['domaindata'], config['nconf_samp'], args.devbsz, config['soptlr'], config['auxlr'], warmup_frac, args.classf_wd, args.base_wd, args.dev_ft_iters, args.step_meta_every, args.tokentform_temp, task_info['metric'], searchOpts_path, pure_transform_str, logfile)
+				retrain_run_command = "CUDA_VISIBLE_DEVICES={} python -u -m scripts.autoaux --prim-task-id {} --train_data_file {} --dev_data_file {} --test_data_file {} --output_dir {} --model_type roberta-base --model_name_or_path roberta-base  --tokenizer_name roberta-base --per_gpu_train_batch_size {}  --gradient_accumulation_steps {} --do_train --learning_rate {} --block_size 512 --logging_steps 10000 --classf_lr {} --classf_patience {} --num_train_epochs {} --classifier_dropout {} --overwrite_output_dir --classf_iter_batchsz  {} --classf_ft_lr 1e-6 --classf_max_seq_len 512 --seed {}  --classf_dev_wd {} --classf_dev_lr {} -searchspace-config {} -task-data {} -in-domain-data {} -num-config-samples {} --dev_batch_sz {} --eval_every 30 -prim-aux-lr {} -auxiliaries-lr {} --classf_warmup_frac {} --classf_wd {} --base_wd {} --dev_fit_iters {} -step-meta-every {} -token_temp {} -use-factored-model --classf-metric {} -warmstart-path {} {} &> {}".format(gpuid, args.task, task_info['trainfile'], task_info['devfile'], task_info['testfile'], outputdir_retrain, pergpubsz, args.grad_accum_steps, args.lr, config['classflr'], args.patience, args.iters, args.classfdp, primiterbsz, seed, args.dev_wd, args.devlr, args.base_spconfig, task_info['taskdata'], task_info['domaindata'], nconf_samp, args.devbsz, config['soptlr'], config['auxlr'], warmup_frac, args.classf_wd, args.base_wd, args.dev_ft_iters, args.step_meta_every, args.tokentform_temp, task_info['metric'], searchOpts_path, extra_flags_str, logfile)
 				run_command = "{}\n{}".format(run_command, retrain_run_command) if run_command else retrain_run_command
 
 
@@ -142,6 +148,8 @@ if __name__ == "__main__":
 	args = parser.parse_args()
 	task_info = get_task_info(args)
 	this_hyper_config = get_hyper_config(args.hyperconfig)
+	if args.adaptive_config_samples:
+		this_hyper_config = {k: v for k, v in this_hyper_config.items() if k != 'nconf_samp'}
 	all_hyperconfigs = get_all_hyperconfigs(this_hyper_config)
 
 	gpu_list = eval(str(args.gpu_list))
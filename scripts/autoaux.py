@@ -178,12 +178,18 @@ def auto_auxiliary(args):
 	# Create the search options object
 	searchOpts = SearchOptions(
 									autoloss_config, args.prim_aux_lr, args.auxiliaries_lr, use_EG=args.use_EG, step_every=args.step_meta_every,
-									use_factored_model=args.use_factored_model, is_cuda=True, token_temp=args.token_temp, warmstart_path=args.warmstart_path, pure_transform=args.pure_transform
+									use_factored_model=args.use_factored_model, is_cuda=True, token_temp=args.token_temp, warmstart_path=args.warmstart_path, pure_transform=args.pure_transform,
+									weight_storage=args.weight_storage, config_sampler=args.config_sampler
+								)
+	if args.adaptive_config_samples:
+		searchOpts.setup_adaptive_sampling(
+									args.min_config_samples, args.num_config_samples,
+									tol=args.config_samples_tol, budget=args.config_samples_budget
 								)
 
 	# enumerate the valid loss configs and get iterators for each loss type
 	max_dataset_len = dtform_and_itr.total_iters()
-	representation_tform = RepTransform(autoloss_config.get_stage(2))
+	representation_tform = RepTransform(autoloss_config.get_stage(2), seed=args.seed)
 
 	# Instantiate the model
 	if args.config_name:
@@ -208,6 +214,12 @@ def auto_auxiliary(args):
 		logger.info("Training new model from scratch")
 		model = AutoModelWithLMHead.from_config(model_config)
 
+	# Sizes used to estimate the cost of configs that have not been timed yet
+	searchOpts.setup_cost_model(
+									args.block_size, model_config.hidden_size, model_config.num_hidden_layers,
+									len(tokenizer), time_budget=args.step_time_budget, mask_proba=args.mlm_probability
+								)
+
 	# Instantiate the wrapper model before moving to device
 	primary_task_info = {
 			'prim_task_id': args.prim_task_id,
@@ -224,6 +236,10 @@ def auto_auxiliary(args):
 										grad_accum_factor=args.gradient_accumulation_steps, batch_sz=args.classf_iter_batchsz,
 										dev_batch_sz=args.dev_batch_sz, share_output_heads=args.share_output_heads
 					)
+	if args.restrict_lm_vocab:
+		vocab_subset = aux_dataOptions.get_vocab_subset(len(tokenizer))
+		logger.info('Restricting the denoising heads to {}/{} tokens'.format(len(vocab_subset), len(tokenizer)))
+		wrapper_model.set_lm_vocab_subset(vocab_subset, num_negatives=args.lm_vocab_negatives)
 	model.to(args.device)
 	wrapper_model.to(args.device)
 	if args.skip_train:
@@ -329,12 +345,15 @@ def auto_auxiliary(args):
 				continue
 
 			# Sample a subset of the valid configurations
-			sample_configs = searchOpts.sample_configurations(args.num_config_samples)
+			num_samples = searchOpts.num_config_samples(args.num_config_samples)
+			sample_configs, importance_weights = searchOpts.sample_configurations(num_samples, return_importance=True)
 			aggregate_data = dtform_and_itr.get_data(sample_configs, searchOpts, representation_tform)
 
 			# This does an automatic filling of the gradients. Accumulates the gradients
 			try:
-				wrapper_model.get_grads_with_auxiliaries(aggregate_data, searchOpts, dtform_and_itr.train_batch_size)
+				wrapper_model.get_grads_with_auxiliaries(
+												aggregate_data, searchOpts, dtform_and_itr.train_batch_size, importance_weights=importance_weights
+											)
 			except Exception as e:
 				print(' | Experienced a runtime error')
 				torch.cuda.empty_cache()
@@ -370,6 +389,9 @@ def auto_auxiliary(args):
 				wrapper_model.reset_dev_head()
 				# Update weights and also clears the gradients
 				searchOpts.update_weighttensor()
+				if args.prune_every > 0 and global_step % args.prune_every == 0:
+					pruned = searchOpts.prune_configs(args.prune_threshold, patience=args.prune_patience)
+					wrapper_model.remove_heads(pruned, searchOpts, optimizer=classifier_optim)
 				torch.cuda.empty_cache()
 				
 				# ask the wrapper to track the stats + tfsummarywriter so we can see in real time